@@ -0,0 +1,57 @@
+import argparse
+import time
+from core.utilities.zeomine_frontier import FrontierQueue
+
+## Frontier benchmark
+#
+# Measures the per-link cost of the crawl frontier as the queue grows. Each
+# "link" is what CoreCrawler.get_links and crawl do per URL: a membership check,
+# an append if the URL is new, and a pop from the front of the queue.
+#
+# Run from the repository root:
+#   python -m benchmarks.frontier_benchmark
+#   python -m benchmarks.frontier_benchmark --sizes 1000,10000 --list
+
+# The old frontier: a list scanned with filter(), popped with pop(0)
+def list_link(queue, add):
+  check = list(filter(lambda a: a['url'] == add['url'], queue))
+  if not check:
+    queue.append(add)
+  queue.pop(0)
+
+def frontier_link(queue, add):
+  if add['url'] not in queue:
+    queue.append(add)
+  queue.pop(0)
+
+# Fill a queue to the given size, then time ops links against it. Half of the
+# links are new URLs and half are already queued.
+def run(size, ops, fill, link):
+  queue = fill([{'url': 'http://example.com/page/' + str(i), 'depth': 1} for i in range(size)])
+  adds = []
+  for i in range(ops):
+    if i % 2:
+      adds.append({'url': 'http://example.com/page/' + str(size - 1 - i), 'depth': 2})
+    else:
+      adds.append({'url': 'http://example.com/new/' + str(i), 'depth': 2})
+  s = time.perf_counter()
+  for add in adds:
+    link(queue, add)
+  e = time.perf_counter()
+  return (e - s) / ops * 1000000
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the crawl frontier')
+  parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='Comma-separated queue sizes')
+  parser.add_argument('--ops', type=int, default=20000, help='Links to time per queue size')
+  parser.add_argument('--list', action='store_true', help='Also time the old list frontier (slow on large queues)')
+  args = parser.parse_args()
+
+  print('%10s %18s %18s' % ('queued', 'FrontierQueue us', 'list us'))
+  for size in [int(s) for s in args.sizes.split(',')]:
+    fq = run(size, args.ops, FrontierQueue, frontier_link)
+    lq = '-'
+    if args.list:
+      # The list frontier is O(n) per link, so time fewer links
+      lq = '%.2f' % run(size, max(10, min(args.ops, 2000000 // size)), list, list_link)
+    print('%10d %18.2f %18s' % (size, fq, lq))
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from core.utilities.zeomine_links import extractors, lxml
+
+## Link extraction benchmark
+#
+# Times each link extractor on a corpus of real pages, and checks that they
+# return the same links as the BeautifulSoup extractor. Pages are read from the
+# crawler_req_text table of a Zeomine database, or from a directory of saved
+# HTML files.
+#
+# Run from the repository root:
+#   python -m benchmarks.link_extraction_benchmark --db path/to/zeomine.db
+#   python -m benchmarks.link_extraction_benchmark --dir path/to/pages --selectors '{"a": ["href"], "img": ["src"]}'
+
+def load_db(path, limit):
+  db = sqlite3.connect(path)
+  rows = db.execute('SELECT response_text FROM crawler_req_text WHERE response_text IS NOT NULL LIMIT ?', (limit,)).fetchall()
+  db.close()
+  return [row[0] for row in rows]
+
+def load_dir(path, limit):
+  pages = []
+  for name in sorted(os.listdir(path)):
+    full = os.path.join(path, name)
+    if os.path.isfile(full):
+      with open(full, encoding='utf-8', errors='replace') as f:
+        pages.append(f.read())
+    if len(pages) >= limit:
+      break
+  return pages
+
+# Extract links from every page, repeats times. Returns ms per page and the links from the last pass.
+def run(extract, pages, selectors, repeats):
+  s = time.perf_counter()
+  for r in range(repeats):
+    found = [extract(page, selectors) for page in pages]
+  e = time.perf_counter()
+  return (e - s) / (repeats * len(pages)) * 1000, found
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the link extractors')
+  parser.add_argument('--db', help='Zeomine database to read crawled pages from')
+  parser.add_argument('--dir', help='Directory of HTML files')
+  parser.add_argument('--limit', type=int, default=1000, help='Maximum number of pages to load')
+  parser.add_argument('--repeats', type=int, default=3, help='Passes over the corpus per extractor')
+  parser.add_argument('--selectors', default='{"a": ["href"]}', help='Link selectors, as JSON')
+  args = parser.parse_args()
+
+  if args.db:
+    pages = load_db(args.db, args.limit)
+  elif args.dir:
+    pages = load_dir(args.dir, args.limit)
+  else:
+    parser.error('one of --db or --dir is required')
+  if not pages:
+    parser.error('no pages found')
+  selectors = json.loads(args.selectors)
+  size = sum(len(page) for page in pages)
+  print('%d pages, %.1f KB average' % (len(pages), size / len(pages) / 1024))
+
+  base, expected = run(extractors['bs4'], pages, selectors, args.repeats)
+  print('%8s %12s %10s %10s' % ('engine', 'ms per page', 'speedup', 'same'))
+  print('%8s %12.3f %10s %10s' % ('bs4', base, '1.00x', 'yes'))
+  for name in ['stream', 'lxml']:
+    if name == 'lxml' and lxml is None:
+      print('%8s %12s' % (name, 'not installed'))
+      continue
+    t, found = run(extractors[name], pages, selectors, args.repeats)
+    same = sum(1 for a, b in zip(found, expected) if a == b)
+    print('%8s %12.3f %9.2fx %10s' % (name, t, base / t, 'yes' if same == len(pages) else '%d/%d' % (same, len(pages))))
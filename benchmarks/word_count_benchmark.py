@@ -0,0 +1,140 @@
+import argparse
+import random
+import sqlite3
+import time
+from collections import Counter
+from core.utilities.zeomine_tokenizer import Tokenizer
+
+## Word count benchmark
+#
+# Times WordCount's tokenizing and counting on a corpus, with the old
+# token-by-token algorithm and with the Tokenizer engine, and checks that the
+# counts are identical, word order included. The corpus is read from the
+# text_extraction table of a Zeomine database, or generated.
+#
+# Run from the repository root:
+#   python -m benchmarks.word_count_benchmark
+#   python -m benchmarks.word_count_benchmark --tokens 5000000 --blacklist a,an,the
+#   python -m benchmarks.word_count_benchmark --db path/to/zeomine.db
+
+# WordCount's defaults
+cleanup_list = [':', ';', '--', '?', '&', '.', '!', ',', '"', '”', '“', '‘','’', '(', ')', "'"]
+
+# The old algorithm
+def in_blacklist(item, blacklist):
+  if not blacklist:
+    return False
+  else:
+    for substr in blacklist:
+      substr = str(substr)
+      if substr in item:
+        return True
+    return False
+
+def clean_text(text, blacklist, min_length):
+  ret = []
+  for t in text:
+    for c in cleanup_list:
+      t = t.replace(c, '')
+    if t:
+      if len(t) >= min_length:
+        if not in_blacklist(t.lower(), blacklist):
+          ret.append(t)
+  return ret
+
+def old_count(rows, blacklist, min_length):
+  run = {}
+  url = {}
+  for tdata in rows:
+    td = tdata[1].strip("'").split(' ')
+    td = clean_text(td, blacklist, min_length)
+    if tdata[0] not in url:
+      url[tdata[0]] = {}
+    for t in td:
+      tl = t.lower()
+      if tl in run:
+        run[tl] += 1
+      else:
+        run[tl] = 1
+      if tl in url[tdata[0]]:
+        url[tdata[0]][tl] += 1
+      else:
+        url[tdata[0]][tl] = 1
+  return run, url
+
+# The Tokenizer engine, as WordCount uses it: consecutive rows for a URL are
+# counted together
+def new_count(rows, blacklist, min_length):
+  tokenizer = Tokenizer(cleanup_list, blacklist, min_length)
+  run = Counter()
+  url = {}
+  group = []
+  for i in range(len(rows) + 1):
+    if group and (i == len(rows) or rows[i][0] != group[0][0]):
+      if group[0][0] not in url:
+        url[group[0][0]] = Counter()
+      tokenizer.count(' '.join([tdata[1].strip("'") for tdata in group]), [run, url[group[0][0]]])
+      group = []
+    if i < len(rows):
+      group.append(rows[i])
+  return run, url
+
+# Generate text_extraction-like rows: repr() strings of punctuated sentences,
+# with the rows for each page together, as TextExtraction writes them
+def generate(tokens, vocabulary, urls):
+  random.seed(1)
+  words = []
+  for i in range(vocabulary):
+    w = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for j in range(random.randint(1, 10)))
+    words.append(w.capitalize() if i % 7 == 0 else w)
+  punct = ['', '', '', '', ',', '.', '!', '?', ':', '--', '"', '(', ')', "'s", '’']
+  rows = []
+  n = 0
+  per_url = max(1, tokens // urls)
+  while n < tokens:
+    length = random.randint(5, 40)
+    sentence = ' '.join(random.choice(words) + random.choice(punct) for j in range(length))
+    rows.append((n // per_url, repr(sentence)))
+    n += length
+  return rows, n
+
+def load_db(path):
+  db = sqlite3.connect(path)
+  rows = db.execute('SELECT url,extracted_text FROM text_extraction').fetchall()
+  db.close()
+  return rows, sum(len(row[1].split(' ')) for row in rows)
+
+def same(a, b):
+  return list(a.items()) == list(b.items())
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark WordCount tokenizing and counting')
+  parser.add_argument('--db', help='Zeomine database to read text_extraction rows from')
+  parser.add_argument('--tokens', type=int, default=1000000, help='Tokens to generate')
+  parser.add_argument('--vocabulary', type=int, default=20000, help='Distinct words to generate')
+  parser.add_argument('--urls', type=int, default=1000, help='URLs to spread generated text over')
+  parser.add_argument('--blacklist', default='', help='Comma-separated blacklist')
+  parser.add_argument('--min-length', type=int, default=1, help='Minimum word length')
+  args = parser.parse_args()
+
+  if args.db:
+    rows, n = load_db(args.db)
+  else:
+    rows, n = generate(args.tokens, args.vocabulary, args.urls)
+  blacklist = [b for b in args.blacklist.split(',') if b]
+  print('%d rows, %d tokens' % (len(rows), n))
+
+  s = time.perf_counter()
+  old_run, old_url = old_count(rows, blacklist, args.min_length)
+  old_time = time.perf_counter() - s
+  s = time.perf_counter()
+  new_run, new_url = new_count(rows, blacklist, args.min_length)
+  new_time = time.perf_counter() - s
+
+  identical = same(old_run, new_run) and list(old_url) == list(new_url) and all(same(old_url[u], new_url[u]) for u in old_url)
+  print('%10s %10s %10s' % ('engine', 'seconds', 'speedup'))
+  print('%10s %10.3f %10s' % ('old', old_time, '1.00x'))
+  print('%10s %10.3f %9.2fx' % ('Tokenizer', new_time, old_time / new_time))
+  print('identical counts: ' + ('yes' if identical else 'NO'))
+  if not identical:
+    raise SystemExit(1)
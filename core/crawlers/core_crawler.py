@@ -1,11 +1,15 @@
+import inspect
 import json
-import random
-import requests
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from selenium import webdriver
-from bs4 import BeautifulSoup
 from selenium.webdriver.firefox.options import Options
 import selenium.webdriver.chrome.service as service
+from core.utilities.zeomine_links import extract_links, extract_tree
+from core.utilities.zeomine_frontier import FrontierQueue, PersistentFrontierQueue
+from core.utilities.zeomine_seen import SeenSet
 
 ## Core Crawler
 #
@@ -32,6 +36,11 @@ class CoreCrawler():
   settings['error_max'] = 10
   settings['load_uncrawled'] = False # Load uncrawled URLs
   settings['save_uncrawled'] = False # Save uncrawled URLs
+  # Keep the URL lists in the crawler_frontier table as the crawl goes, so a
+  # crawl can be resumed after a crash. Use load_uncrawled to resume.
+  settings['persistent_frontier'] = False
+  # Number of URLs per type held in memory when persistent_frontier is on
+  settings['frontier_window'] = 10000
 
   ## Behavior settings
   # Crawl delay and path whitelist/blacklist. May be modified by a site's robots.txt
@@ -40,16 +49,34 @@ class CoreCrawler():
   settings['crawler']['req_delay'] = {}
   settings['crawler']['req_delay']['method'] = 'static' # Delay calculation method. See self.calculate_delay
   settings['crawler']['req_delay']['time'] = 0 # Delay calculation method. See self.calculate_delay
-  # 'selenium' or 'requests'
+  # 'selenium', 'requests', or 'threaded' (requests with several pages in flight)
   settings['crawler']['req_method'] = 'requests'
+  # Number of requests kept in flight by the 'threaded' req_method
+  settings['crawler']['workers'] = 4
+  # Write fetched pages to the database from a separate storage thread, so the
+  # next page can be fetched while the last one is stored. storage_queue is the
+  # number of pages that may wait for storage before fetching is held back.
+  settings['crawler']['storage_thread'] = False
+  settings['crawler']['storage_queue'] = 100
   # Add failed URLs back into the queue. Will not retry immediately, but will
   # instead append URLs to the end of the queue.
   settings['crawler']['retry_on_error'] = True
+  # Number of browsers rendering pages at once with the 'selenium' req_method.
+  # Each page is loaded in a worker thread that has a browser to itself, and
+  # the Selenium plugins run there while the page is open. With more than one
+  # browser, the plugins run before the page is stored and its links added.
+  # Every Selenium plugin's core_crawler_selenium must take a third browser
+  # argument, or only one browser is started.
+  settings['crawler']['browser_pool'] = 1
   # Time until browser times out
   # TODO add to requests engine
   settings['crawler']['timeout'] = 30
   # Skip previously crawled items
   settings['crawler']['skip_crawled'] = False
+  # Sizing for the Bloom filter in front of the crawled URL check: the expected
+  # number of URLs, and the rate of lookups that fall through to the exact check.
+  settings['crawler']['seen_capacity'] = 1000000
+  settings['crawler']['seen_error_rate'] = 0.01
   #Selenium browser + location of driver/browser binaries
   settings['crawler']['selenium_browser'] = 'Firefox'
   settings['crawler']['selenium_driver_path'] = False
@@ -69,6 +96,8 @@ class CoreCrawler():
   settings['links'] = {}
   # Selectors for extracting links. Dict with selector as key, list of allowed data properties as value
   settings['links']['selectors'] = {'a': ['href']}
+  # Link extractor: 'stream' (standard library tokenizer), 'lxml' (if installed), or 'bs4' (BeautifulSoup tree)
+  settings['links']['extractor'] = 'stream'
   # Crawl randomly. True: Go through links randomly, False: go through a list (permits prioritization)
   settings['links']['random'] = False
   # Do not read links below a certain depth.
@@ -91,6 +120,9 @@ class CoreCrawler():
 
   # Extra plugins for acting when deermining whether a URL is crawled
   check_crawled_plugins = {}
+
+  # Extra plugins for acting on each internal page's HTML as it is saved
+  document_plugins = {}
   
   # Add the Selenium post-GET plugin names here. They must also be added/set up in Zeomine, as we will get the plugins there
   settings['selenium_plugins'] = []
@@ -98,19 +130,41 @@ class CoreCrawler():
   # Add the "Check Crawled" plugin names here. They must also be added/set up in Zeomine, as we will get the plugins there
   settings['check_crawled_plugins'] = []
 
+  # Add the document plugin names here. They must also be added/set up in Zeomine, as we will get the plugins there.
+  # These plugins extract from each page during the crawl, instead of re-reading every page afterwards.
+  settings['document_plugins'] = []
+
   # Local data dict
   data = {}
   data['active_domain'] = ''
   data['error_count'] = 0
 
-  data['urls_to_crawl'] = {'internal': [], 'external': [], 'file': []}
+  # URLs waiting to be crawled. FrontierQueue indexes them by URL for fast lookups.
+  data['urls_to_crawl'] = {'internal': FrontierQueue(), 'external': FrontierQueue(), 'file': FrontierQueue()}
   data['crawled_urls'] = {'internal': [], 'external': [], 'file': []}
   data['url_counts'] = {'internal': 0, 'external': 0, 'file': 0, 'total': 0}
-  # DB cache - mainly meant to cache domain/URL IDs so we don't have to do select statements
+  # URLs taken off the list whose requests are still in flight ('threaded' req_method)
+  data['in_flight'] = set()
+  # IDs of crawled URLs: this run's, plus past runs' if skip_crawled is set
+  data['seen'] = SeenSet()
+  # Browsers in the pool. The first is also self.browser.
+  data['browsers'] = []
+  # Parse internal pages for the document cache. Set in initiate().
+  data['parse_pages'] = False
+  # Whether each Selenium plugin takes a browser argument. Set in load_config().
+  data['selenium_plugin_browser'] = {}
+  # Document plugins that failed, and are left to read pages after the crawl
+  data['failed_document_plugins'] = set()
+  # Pages waiting for the storage thread, and the thread itself
+  data['storage_queue'] = None
+  data['storage_thread'] = None
+  # Pages the storage thread failed to write, to be queued again by the crawl
+  # thread, and the error to raise there in debug mode
+  data['storage_failed'] = queue.Queue()
+  data['storage_error'] = None
+  # DB cache for domain info. Domain and URL IDs are cached in Zeomine.id_cache.
   data['cache'] = {}
-  data['cache']['domains'] = {}
   data['cache']['domain_info'] = {}
-  data['cache']['urls'] = {}
 
   ##############################################################################
   # Helper Functions
@@ -148,18 +202,21 @@ class CoreCrawler():
   ###########
   # Domain/URL Functions
 
-  # Get the database id for a domain. Try the cache first, then select, and finally create.
+  # Get the database id for a domain. Try the shared id cache first, then select, and finally create.
   def get_domain_id(self, string, https = None, recursed = False):
-    if string in self.data['cache']['domains']:
-      return self.data['cache']['domains'][string]
+    d = self.z_obj.id_cache['domains'].get(string)
+    if d:
+      return d
     else:
       d = self.z_obj.fetchone('select rowid from domains where domain=?', (string,))
       if d:
+        self.z_obj.id_cache['domains'].put(string, d[0])
         return d[0]
       else:
         h = self.settings['https'] if not https else https
         self.z_obj.ex('insert into domains values (?,?,NULL)',(string, h,))
         if self.z_obj.cursor.lastrowid:
+          self.z_obj.id_cache['domains'].put(string, self.z_obj.cursor.lastrowid)
           return self.z_obj.cursor.lastrowid
         elif not recursed:
           return self.get_domain_id(string, https, True)
@@ -179,17 +236,20 @@ class CoreCrawler():
       else:
         return None
 
-  # Get the database id for a url. Try the cache first, then select, and finally create.
+  # Get the database id for a url. Try the shared id cache first, then select, and finally create.
   def get_url_id(self, string, domain_id, recursed = False):
-    if string in self.data['cache']['urls']:
-      return self.data['cache']['urls'][string]
+    d = self.z_obj.id_cache['urls'].get(string)
+    if d:
+      return d
     else:
       d = self.z_obj.fetchone('select rowid from urls where url=?', (string,))
       if d:
+        self.z_obj.id_cache['urls'].put(string, d[0])
         return d[0]
       else:
         self.z_obj.ex('insert into urls values (?,?)',(string, domain_id,))
         if self.z_obj.cursor.lastrowid:
+          self.z_obj.id_cache['urls'].put(string, self.z_obj.cursor.lastrowid)
           return self.z_obj.cursor.lastrowid
         elif not recursed:
           return self.get_url_id(string, domain_id, True)
@@ -277,101 +337,261 @@ class CoreCrawler():
 
   # Get a URL's data, and add it to the list
   def crawl_url(self, url, url_type, domain_id):
-    if self.settings['crawler']['req_method'] == 'requests':
+    if self.settings['crawler']['req_method'] in ['requests', 'threaded']:
       self.requests_get_data(url, url_type, domain_id)
     if self.settings['crawler']['req_method'] == 'selenium':
       self.selenium_get_data(url, url_type, domain_id)
 
   # Get data with Selenium module
   def selenium_get_data(self, url, url_type, domain_id):
-    insert_data = ()
-    u = url['url']
     uid = self.get_url_id(url['url'], domain_id)
+    req_text, load_time = self.selenium_fetch(url, self.browser)
+    self.selenium_store(url, url_type, domain_id, uid, req_text, load_time)
+    self.run_selenium_plugins(url['url'], uid, self.browser)
+
+  # Load a page in a browser, and read its HTML
+  def selenium_fetch(self, url, browser):
     # Make a GET request and record data
     s = time.time()
-    self.browser.get(u)
+    browser.get(url['url'])
     e = time.time()
     # Reset the screen each time
-    self.browser.set_window_size(1280,960)
-    # Record Data
-    req_text = self.browser.find_element_by_tag_name("html").get_attribute('innerHTML')
-    insert_data = insert_data + (self.z_obj.run_id,)
-    insert_data = insert_data + (uid,)
-    insert_data = insert_data + (url_type,)
-    insert_data = insert_data + (url['depth'],)
-    insert_data = insert_data + (None,)
-    insert_data = insert_data + (round((e - s), 4),)
-    self.z_obj.ex('insert into crawler_basic_data values (?,?,?,?,?,?)', insert_data)
-    cbi = self.z_obj.cursor.lastrowid
-    self.z_obj.ex('insert into crawler_req_text values (?,?,?)', (self.z_obj.run_id, cbi, req_text))
+    browser.set_window_size(1280,960)
+    req_text = browser.find_element_by_tag_name("html").get_attribute('innerHTML')
+    return req_text, round((e - s), 4)
+
+  # Record a page read by selenium_fetch, and add any links found
+  def selenium_store(self, url, url_type, domain_id, uid, req_text, load_time):
+    page = {'url': url, 'type': url_type, 'url_id': uid, 'status': None, 'load_time': load_time}
+    page['text'] = req_text
+    page['headers'] = None
+    page['parse'] = None
+    if req_text and url_type == 'internal':
+      page['parse'] = self.parse_page(req_text)
+    self.store_page(page)
     if req_text and url_type == 'internal':
-      self.get_links(url, req_text, domain_id)
+      self.get_links(url, req_text, domain_id, page['parse'])
+
+  # Selenium plugins: act on a page while it is open in the browser. Plugins
+  # that take a browser argument are given the one holding the page. Others
+  # use self.browser.
+  def run_selenium_plugins(self, current_url, current_url_id, browser):
     for plugin in self.selenium_plugins:
       if callable(getattr(self.selenium_plugins[plugin], 'core_crawler_selenium', False)):
-        self.selenium_plugins[plugin].core_crawler_selenium(u, uid)
+        if self.data['selenium_plugin_browser'][plugin]:
+          self.selenium_plugins[plugin].core_crawler_selenium(current_url, current_url_id, browser)
+        else:
+          self.selenium_plugins[plugin].core_crawler_selenium(current_url, current_url_id)
+
+  # Whether a Selenium plugin's core_crawler_selenium takes a browser argument
+  def takes_browser(self, plugin):
+    try:
+      inspect.signature(plugin.core_crawler_selenium).bind(None, None, None)
+      return True
+    except (AttributeError, TypeError, ValueError):
+      return False
+
+  # Browser pool task: load a page in the pool's browser at index, and run the
+  # Selenium plugins on it. Storing the page is left to the crawl thread, so
+  # unlike selenium_get_data, the plugins run before the page is stored.
+  def selenium_pool_fetch(self, url, uid, index):
+    browser = self.data['browsers'][index]
+    req_text, load_time = self.selenium_fetch(url, browser)
+    self.run_selenium_plugins(url['url'], uid, browser)
+    return req_text, load_time
 
   # Get data with Requests module
   def requests_get_data(self, url, url_type, domain_id):
-    insert_data = ()
-    head = {'User-Agent': self.z_obj.settings['user_agent']}
+    req, load_time = self.requests_fetch(url)
+    self.requests_store(url, url_type, domain_id, req, load_time)
+
+  # Make the GET request only. This does not touch the database, so it is safe
+  # to run from the 'threaded' worker pool.
+  def requests_fetch(self, url):
     s = time.time()
-    req = requests.get(url['url'], headers=head)
+    req = self.z_obj.http_get(url['url'])
     e = time.time()
-    insert_data = insert_data + (self.z_obj.run_id,)
-    insert_data = insert_data + (self.get_url_id(url['url'], domain_id),)
-    insert_data = insert_data + (url_type,)
-    insert_data = insert_data + (url['depth'],)
-    insert_data = insert_data + (req.status_code,)
-    insert_data = insert_data + (round((e - s), 4),)
-    self.z_obj.ex('insert into crawler_basic_data values (?,?,?,?,?,?)', insert_data)
-    cbi = self.z_obj.cursor.lastrowid
-    self.z_obj.ex('insert into crawler_req_text values (?,?,?)', (self.z_obj.run_id, cbi, req.text))
-    self.z_obj.ex('insert into crawler_req_headers values (?,?,?)', (self.z_obj.run_id, cbi, json.dumps(dict(req.headers))))
+    return req, round((e - s), 4)
+
+  # Record the response from requests_fetch, and add any links found
+  def requests_store(self, url, url_type, domain_id, req, load_time):
+    uid = self.get_url_id(url['url'], domain_id)
+    page = {'url': url, 'type': url_type, 'url_id': uid, 'status': req.status_code, 'load_time': load_time}
+    page['text'] = req.text
+    page['headers'] = json.dumps(dict(req.headers))
+    page['parse'] = None
+    if req.status_code == 200 and url_type == 'internal':
+      page['parse'] = self.parse_page(req.text)
+    self.store_page(page)
     if req.status_code == 200 and url_type == 'internal':
-      self.get_links(url, req.text, domain_id)
+      self.get_links(url, req.text, domain_id, page['parse'])
+
+  # Parse a page into a tree for the document cache, if the crawl will use it:
+  # the 'bs4' link extractor, or the document plugins. Plugins that only run
+  # after the crawl parse the pages they need then.
+  def parse_page(self, text):
+    if self.data['parse_pages']:
+      return self.z_obj.documents.get(None, text)
+    return None
+
+  # Whether parse_page builds trees, worked out once the plugins are loaded
+  def uses_documents(self):
+    if self.settings['links']['extractor'] == 'bs4':
+      return True
+    if self.z_obj.documents is None or not self.z_obj.documents.max_bytes:
+      return False
+    for plugin in self.document_plugins:
+      if callable(getattr(self.document_plugins[plugin], 'core_crawler_document', False)):
+        return True
+    return False
+
+  ###########
+  # Storage
+
+  # Hand a fetched page to the storage thread, or write it now if there isn't one.
+  # The page is marked as crawled right away, so its links are not queued again.
+  def store_page(self, page):
+    self.check_storage()
+    self.data['seen'].add(page['url_id'])
+    if self.data['storage_thread']:
+      # Blocks while the queue is full, holding back the fetchers
+      self.data['storage_queue'].put(page)
+    else:
+      self.write_page(page)
+
+  # Write a page's crawl data. The crawler_basic_data rowid links the text and
+  # headers rows, so hold the DB lock until we have it.
+  def write_page(self, page):
+    insert_data = ()
+    insert_data = insert_data + (self.z_obj.run_id,)
+    insert_data = insert_data + (page['url_id'],)
+    insert_data = insert_data + (page['type'],)
+    insert_data = insert_data + (page['url']['depth'],)
+    insert_data = insert_data + (page['status'],)
+    insert_data = insert_data + (page['load_time'],)
+    with self.z_obj.db_lock:
+      self.z_obj.ex('insert into crawler_basic_data values (?,?,?,?,?,?)', insert_data)
+      cbi = self.z_obj.cursor.lastrowid
+      self.z_obj.queue('insert into crawler_req_text values (?,?,?)', (self.z_obj.run_id, cbi, page['text']))
+      if page['headers'] is not None:
+        self.z_obj.queue('insert into crawler_req_headers values (?,?,?)', (self.z_obj.run_id, cbi, page['headers']))
+      # The page is saved, so it can come off a persistent frontier
+      self.data['urls_to_crawl'][page['type']].done(page['url'])
+    # Share the parsed page with plugins, now that it has a crawl_data id
+    if page.get('parse') is not None:
+      self.z_obj.documents.put(cbi, page['parse'], len(page['text']))
+    if page['type'] == 'internal' and page['text']:
+      self.run_document_plugins(page, cbi)
+    return cbi
+
+  # Document plugins: extract from a page as soon as it is saved. This runs in
+  # the storage thread, if there is one. A plugin that fails is not run on any
+  # more pages, so its watermark stays before the failed page, and it reads
+  # that page and the rest in evaluate_data after the crawl.
+  def run_document_plugins(self, page, cbi):
+    for plugin in self.document_plugins:
+      if plugin in self.data['failed_document_plugins']:
+        continue
+      if callable(getattr(self.document_plugins[plugin], 'core_crawler_document', False)):
+        if self.z_obj.debug_mode:
+          self.document_plugins[plugin].core_crawler_document(page['url']['url'], page['url_id'], cbi, page['text'])
+        else:
+          try:
+            self.document_plugins[plugin].core_crawler_document(page['url']['url'], page['url_id'], cbi, page['text'])
+          except Exception as e:
+            self.z_obj.pprint('Document plugin error in ' + plugin + ' for ' + page['url']['url'] + ': ' + str(e), 0)
+            self.data['failed_document_plugins'].add(plugin)
+
+  # Storage thread: write pages from the queue until we get None. Errors can't
+  # be raised from here, so in debug mode they are raised in the crawl thread
+  # by check_storage(). Otherwise the page is handed back to be crawled again.
+  def storage_worker(self):
+    while True:
+      page = self.data['storage_queue'].get()
+      if page is None:
+        self.data['storage_queue'].task_done()
+        break
+      try:
+        self.write_page(page)
+      except Exception as e:
+        if self.z_obj.debug_mode:
+          self.data['storage_error'] = e
+        else:
+          self.z_obj.pprint('Storage Error for ' + page['url']['url'] + ': ' + str(e), 0)
+          self.data['storage_failed'].put(page)
+      self.data['storage_queue'].task_done()
+
+  # Crawl thread side of storage errors: raise the storage thread's error, if
+  # there is one, and take pages that failed to save back out of the seen set.
+  # They are added back into the queue if retry_on_error is set.
+  def check_storage(self):
+    e = self.data['storage_error']
+    if e is not None:
+      self.data['storage_error'] = None
+      raise e
+    while not self.data['storage_failed'].empty():
+      page = self.data['storage_failed'].get()
+      self.data['seen'].discard(page['url_id'])
+      self.data['urls_to_crawl'][page['type']].done(page['url'])
+      if self.settings['crawler']['retry_on_error']:
+        self.data['urls_to_crawl'][page['type']].append(page['url'])
+
+  # Start the storage thread, if it is turned on
+  def start_storage(self):
+    if self.settings['crawler']['storage_thread'] and not self.data['storage_thread']:
+      self.data['storage_queue'] = queue.Queue(maxsize = max(1, int(self.settings['crawler']['storage_queue'])))
+      self.data['storage_thread'] = threading.Thread(target = self.storage_worker, daemon = True)
+      self.data['storage_thread'].start()
+
+  # Write everything still queued, and stop the storage thread
+  def stop_storage(self):
+    if self.data['storage_thread']:
+      self.data['storage_queue'].put(None)
+      self.data['storage_thread'].join()
+      self.data['storage_thread'] = None
+      self.check_storage()
 
   # Adds links to the crawl list, returns the outbound link count, and builds the inbound link count
-  def get_links(self, url, url_text, domain_id):
-    parse = BeautifulSoup(url_text, 'html.parser')
+  def get_links(self, url, url_text, domain_id, parse = None):
     link_set = []
-    for selector in self.settings['links']['selectors']:
-      for item in parse.find_all(selector):
-        for prop in self.settings['links']['selectors'][selector]:
-          u = item.get(prop)
-          # Get the full URL and its domain info
-          if u and not self.is_excluded(u) and self.is_required(u):
-            dom = self.extract_domain(u)
-            di = 0
-            add = {}
-            if dom:
-              di = self.get_domain_id(dom)
-              d_info = self.get_domain_info(di)
-              add = {'url': u, 'depth': url['depth'] + 1}
-            else:
-              di = domain_id
-              d_info = self.get_domain_info(di)
-              pre = 'https://' if d_info[1] else 'http://'
-              add_url = ''.join([pre, d_info[0], u])
-              add = {'url': add_url, 'depth': url['depth'] + 1}
-            if add and di:
-              typ = self.get_url_type(add['url'])
-              # Create a link
-              fro = self.get_url_id(url['url'], domain_id)
-              to = self.get_url_id(add['url'], di)
-              link_set.append((self.z_obj.run_id, fro, to))
-              ## Add to crawl list
-              # If 'skip_crawled' is set, then we will search all instances, not just the current one.
-              # TODO add plugin checks
-              check1 = False
-              if self.settings['crawler']['skip_crawled']:
-                check1 = self.z_obj.fetchone('select * from crawler_basic_data where url=?', (to,))
-              else:
-                check1 = self.z_obj.fetchone('select * from crawler_basic_data where zeomine_instance=? and url=?', (self.z_obj.run_id, to))
-              check2 = list(filter(lambda a: a['url'] == add['url'], self.data['urls_to_crawl'][typ]))
-              if not check1 and not check2:
-                self.z_obj.pprint(': '.join(["Adding", add['url']]), 2)
-                self.data['urls_to_crawl'][typ].append(add)
-    self.z_obj.exm('insert into links values (?,?,?)',link_set)
+    # The source page's id is the same for every link
+    fro = self.get_url_id(url['url'], domain_id)
+    # Pages may be parsed for plugins too, so only read links from the tree if
+    # that is the configured extractor
+    if parse is not None and self.settings['links']['extractor'] == 'bs4':
+      links = extract_tree(parse, self.settings['links']['selectors'])
+    else:
+      links = extract_links(url_text, self.settings['links']['selectors'], self.settings['links']['extractor'])
+    for u in links:
+      # Get the full URL and its domain info
+      if not self.is_excluded(u) and self.is_required(u):
+        dom = self.extract_domain(u)
+        di = 0
+        add = {}
+        if dom:
+          di = self.get_domain_id(dom)
+          d_info = self.get_domain_info(di)
+          add = {'url': u, 'depth': url['depth'] + 1}
+        else:
+          di = domain_id
+          d_info = self.get_domain_info(di)
+          pre = 'https://' if d_info[1] else 'http://'
+          add_url = ''.join([pre, d_info[0], u])
+          add = {'url': add_url, 'depth': url['depth'] + 1}
+        if add and di:
+          typ = self.get_url_type(add['url'])
+          # Create a link
+          to = self.get_url_id(add['url'], di)
+          link_set.append((self.z_obj.run_id, fro, to))
+          ## Add to crawl list
+          # If 'skip_crawled' is set, the seen set also holds URLs from all previous instances.
+          # TODO add plugin checks
+          check1 = to in self.data['seen']
+          check2 = add['url'] in self.data['in_flight'] or add['url'] in self.data['urls_to_crawl'][typ]
+          if not check1 and not check2:
+            self.z_obj.pprint(': '.join(["Adding", add['url']]), 2)
+            self.data['urls_to_crawl'][typ].append(add)
+    self.z_obj.queuem('insert into links values (?,?,?)', link_set)
   
   # Removes previously crawled URLs
   # This is called just before crawling starts, and removes items which have already been crawled in another instance.
@@ -382,10 +602,9 @@ class CoreCrawler():
         domain = self.extract_domain(url['url'])
         domain_id = self.get_domain_id(domain)
         url_id = self.get_url_id(url['url'], domain_id)
-        crawlercheck = self.z_obj.fetchone('select * from crawler_basic_data where url=?', (url_id,))
-        if crawlercheck:
+        if url_id in self.data['seen']:
           rem = True
-          for plugin in self.selenium_plugins:
+          for plugin in self.check_crawled_plugins:
             if callable(getattr(self.check_crawled_plugins[plugin], 'check_crawled', False)):
               # True: URL already crawled and data recorded - remove
               # False: URL not crawled yet - do not remove
@@ -398,11 +617,64 @@ class CoreCrawler():
           pass
     
   
+  # Check the max_links and max_time limits for a URL type. 'pending' is the
+  # number of URLs already handed out but not yet counted, e.g. requests in flight.
+  def within_limits(self, typ, crawl_start, crawl_start_all, pending = 0):
+    max_links = self.settings['links']['max_links']
+    max_time = self.settings['links']['max_time']
+    now = time.time()
+    return (not max_links[typ] or self.data['url_counts'][typ] + pending < max_links[typ]) \
+    and (not max_links['total'] or self.data['url_counts']['total'] + pending < max_links['total']) \
+    and (not max_time[typ] or now - crawl_start <= max_time[typ]) \
+    and (not max_time['total'] or now - crawl_start_all <= max_time['total'])
+
+  # Take the next URL to crawl off the list
+  def next_url(self, typ):
+    if self.settings['links']['random']:
+      return self.data['urls_to_crawl'][typ].pop_random()
+    return self.data['urls_to_crawl'][typ].pop(0)
+
+  # Handle a URL that failed to crawl. index is the pool browser it failed in.
+  def crawl_error(self, url, typ, index = 0):
+    self.data['error_count'] += 1
+    self.z_obj.pprint('Crawl Error ' + str(self.data['error_count']), 0)
+    # The URL is finished with. Add it back into the queue if we have that option set
+    self.data['urls_to_crawl'][typ].done(url)
+    if self.settings['crawler']['retry_on_error']:
+      self.data['urls_to_crawl'][typ].append(url)
+    # Sometimes the issue is the browser failing. This will fix it.
+    self.restart_browser(index)
+    if self.data['error_count'] >= self.settings['error_max']:
+      # We are probably going to crash. Save everything! The crawl may go on,
+      # so the storage thread is left running, and only the failed browser
+      # was restarted above. Pool browsers may still be loading pages.
+      self.save_progress()
+      # Turn on debug mode.
+      # You are probably going to crash: usually you are here
+      # because something went wrong and isn't self-correcting.
+      self.z_obj.debug_mode = True
+
   ###########
   # Initiate/Restart Browser
   
-  # Initiate a brower instance
+  # Start the browser, or browser_pool browsers. self.browser is the first.
   def initiate_browser(self):
+    size = max(1, int(self.settings['crawler']['browser_pool']))
+    if size > 1 and not all(self.data['selenium_plugin_browser'].values()):
+      # These plugins would read the page from self.browser, which is only
+      # one of the pool's browsers
+      self.z_obj.pprint('Some Selenium plugins do not take a browser argument, so browser_pool is set to 1.', 0)
+      size = 1
+    if size > 1:
+      # Browsers are slow to start, so start them side by side
+      with ThreadPoolExecutor(max_workers = size) as pool:
+        self.data['browsers'] = list(pool.map(lambda b: self.new_browser(), range(size)))
+    else:
+      self.data['browsers'] = [self.new_browser()]
+    self.browser = self.data['browsers'][0]
+
+  # Create a brower instance
+  def new_browser(self):
     path = self.settings['crawler']['selenium_driver_path']
     if self.settings['crawler']['selenium_browser'] == 'Firefox':
       fp = webdriver.FirefoxProfile()
@@ -414,10 +686,8 @@ class CoreCrawler():
         options.set_headless(True)
       if path:
         brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])(path, firefox_profile=fp, options=options)
-        self.browser = brow
       else:
         brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])(firefox_profile=fp, options=options)
-        self.browser = brow
     elif self.settings['crawler']['selenium_browser'] == 'Chrome':
       serv = None
       if path:
@@ -429,24 +699,23 @@ class CoreCrawler():
       if self.settings['crawler']['selenium_browser_path']:
         capabilities = {'chrome.binary': self.settings['crawler']['selenium_browser_path']}
         brow = webdriver.Remote(serv.service_url, capabilities)
-        self.browser = brow
       else:
         brow = webdriver.Remote(serv.service_url, capabilities)
-        self.browser = brow
     else:
       if path:
         brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])(path)
-        self.browser = brow
       else:
         brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])()
-        self.browser = brow
-    self.browser.set_page_load_timeout(self.settings['crawler']['timeout'])
+    brow.set_page_load_timeout(self.settings['crawler']['timeout'])
+    return brow
   
-  def restart_browser(self):
+  # Replace the pool browser at index with a new one
+  def restart_browser(self, index = 0):
     if self.settings['crawler']['req_method'] == 'selenium':
       try:
-        self.browser.quit()
-        self.initiate_browser()
+        self.data['browsers'][index].quit()
+        self.data['browsers'][index] = self.new_browser()
+        self.browser = self.data['browsers'][0]
       except:
         self.z_obj.pprint('Failed to restart browser', 0)
 
@@ -472,11 +741,17 @@ class CoreCrawler():
         if plug in self.z_obj.plugins:
           self.selenium_plugins[plug] = self.z_obj.plugins[plug]
           self.selenium_plugins[plug].parent_obj = self
+          self.data['selenium_plugin_browser'][plug] = self.takes_browser(self.selenium_plugins[plug])
     if self.settings['check_crawled_plugins']:
       for plug in self.settings['check_crawled_plugins']:
         if plug in self.z_obj.plugins:
           self.check_crawled_plugins[plug] = self.z_obj.plugins[plug]
           self.check_crawled_plugins[plug].parent_obj = self
+    if self.settings['document_plugins']:
+      for plug in self.settings['document_plugins']:
+        if plug in self.z_obj.plugins:
+          self.document_plugins[plug] = self.z_obj.plugins[plug]
+          self.document_plugins[plug].parent_obj = self
     
     # We need to set the active domain for certin items which need it in initiate()
     self.data['active_domain'] = self.settings['domain']
@@ -489,15 +764,43 @@ class CoreCrawler():
     self.z_obj.pprint('Successfully loaded CoreCrawler.', 2, 2)
 
   def initiate(self):
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS crawler_basic_data (zeomine_instance text, url int, type text, depth int, status text, load_time real)')
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS crawler_req_text (zeomine_instance text, crawl_data int, response_text text)')
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS crawler_req_headers (zeomine_instance text, crawl_data int, response_headers text)')
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS links (zeomine_instance text, from_url int, to_url int)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS crawler_basic_data (zeomine_instance text, url int, type text, depth int, status text, load_time real)',
+      'CREATE TABLE IF NOT EXISTS crawler_req_text (zeomine_instance text, crawl_data int, response_text text)',
+      'CREATE TABLE IF NOT EXISTS crawler_req_headers (zeomine_instance text, crawl_data int, response_headers text)',
+      'CREATE TABLE IF NOT EXISTS links (zeomine_instance text, from_url int, to_url int)',
+      'CREATE TABLE IF NOT EXISTS crawler_frontier (url text, type text, depth int)',
+      'CREATE UNIQUE INDEX IF NOT EXISTS crawler_frontier_type_url ON crawler_frontier (type, url)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS crawler_basic_data_instance_url ON crawler_basic_data (zeomine_instance, url)',
+      'CREATE INDEX IF NOT EXISTS crawler_req_text_instance ON crawler_req_text (zeomine_instance, crawl_data)',
+      'CREATE INDEX IF NOT EXISTS crawler_req_headers_instance ON crawler_req_headers (zeomine_instance, crawl_data)',
+      'CREATE INDEX IF NOT EXISTS links_instance ON links (zeomine_instance)',
+    ])
+    self.z_obj.migrate('CoreCrawler', migrations)
+    self.data['parse_pages'] = self.uses_documents()
+    if self.settings['persistent_frontier']:
+      # Start from an empty frontier unless we are resuming the last crawl
+      if not self.settings['load_uncrawled']:
+        self.z_obj.ex('DELETE FROM crawler_frontier')
+      # Move any URLs added so far, e.g. initial_urls, onto the saved frontier
+      for typ in self.data['urls_to_crawl']:
+        queued = self.data['urls_to_crawl'][typ]
+        self.data['urls_to_crawl'][typ] = PersistentFrontierQueue(self.z_obj, typ, self.settings['frontier_window'])
+        for url in queued:
+          self.data['urls_to_crawl'][typ].append(url)
+      self.z_obj.com()
     if self.settings['crawler']['req_method'] == 'selenium':
       self.initiate_browser()
     
 
   def load_previous_state(self):
+    # Build the set of crawled URLs once, instead of checking the database for every link
+    self.data['seen'] = SeenSet(self.settings['crawler']['seen_capacity'], self.settings['crawler']['seen_error_rate'])
+    if self.settings['crawler']['skip_crawled']:
+      self.data['seen'].load(u[0] for u in self.z_obj.fetchall('SELECT DISTINCT url FROM crawler_basic_data WHERE url IS NOT NULL'))
     if self.settings['load_uncrawled']:
       try:
         uncrawled = self.z_obj.fetchall('SELECT * from uncrawled_urls')
@@ -505,7 +808,6 @@ class CoreCrawler():
           add = {'url': u[0],'depth': u[2]}
           self.data['urls_to_crawl'][u[1]].append(add)
         self.z_obj.excom('DELETE FROM uncrawled_urls')
-        self.z_obj.excom('VACUUM')
       except:
         pass
 
@@ -522,63 +824,152 @@ class CoreCrawler():
     # a previous crawl that failed with an error.
     if self.settings['crawler']['skip_crawled']:
       self.remove_crawled()
+    self.start_storage()
     # Crawl through each type of url
     crawl_start_all = time.time()
     i = 0
     for typ in sorted(self.data['urls_to_crawl'], reverse = True):
       if typ not in self.settings['links']['exclude_type']:
         crawl_start = time.time()
-        while self.data['urls_to_crawl'][typ] \
-        and (self.data['url_counts'][typ] < self.settings['links']['max_links'][typ] or not self.settings['links']['max_links'][typ]) \
-        and (self.data['url_counts']['total'] < self.settings['links']['max_links']['total'] or not self.settings['links']['max_links']['total']) \
-        and (time.time() - crawl_start <= self.settings['links']['max_time'][typ] or not self.settings['links']['max_time'][typ]) \
-        and (time.time() - crawl_start <= self.settings['links']['max_time']['total'] or not self.settings['links']['max_time']['total']):
+        if self.settings['crawler']['req_method'] == 'threaded':
+          i = self.crawl_threaded(typ, domain_id, i, crawl_start, crawl_start_all)
+        elif self.settings['crawler']['req_method'] == 'selenium' and len(self.data['browsers']) > 1:
+          i = self.crawl_browsers(typ, domain_id, i, crawl_start, crawl_start_all)
+        else:
+          while self.data['urls_to_crawl'][typ] and self.within_limits(typ, crawl_start, crawl_start_all):
+            i += 1
+            # Pick the url to crawl
+            url = self.next_url(typ)
+            # Crawl the page
+            self.z_obj.pprint(''.join(["Crawling #", str(i), ': ', url['url']]), 1)
+            if self.z_obj.debug_mode:
+              self.crawl_url(url, typ, domain_id)
+            else:
+              try:
+                self.crawl_url(url, typ, domain_id)
+                self.data['error_count'] = 0
+              except:
+                self.crawl_error(url, typ)
+            self.data['url_counts'][typ] += 1
+            self.data['url_counts']['total'] += 1
+            # Write any uncommitted data
+            self.z_obj.com()
+            time.sleep(self.calculate_delay(self.settings['crawler']['req_delay']['method'], self.settings['crawler']['req_delay']['time']))
+    self.stop_storage()
+
+  # Crawl one URL type with several requests in flight. Only the GET requests
+  # run in the worker threads. Responses are stored (or handed to the storage
+  # thread) and their links added here, one at a time, so the URL lists are
+  # only used from this thread.
+  def crawl_threaded(self, typ, domain_id, i, crawl_start, crawl_start_all):
+    workers = max(1, int(self.settings['crawler']['workers']))
+    delay = self.calculate_delay(self.settings['crawler']['req_delay']['method'], self.settings['crawler']['req_delay']['time'])
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+      while True:
+        # Top up the pool. Requests in flight count against max_links.
+        while len(in_flight) < workers and self.data['urls_to_crawl'][typ] \
+        and self.within_limits(typ, crawl_start, crawl_start_all, len(in_flight)):
           i += 1
-          # Pick the url to crawl
-          if self.settings['links']['random']:
-            random.shuffle(self.data['urls_to_crawl'][typ])
-          url = self.data['urls_to_crawl'][typ].pop(0)
-          # Crawl the page
+          url = self.next_url(typ)
           self.z_obj.pprint(''.join(["Crawling #", str(i), ': ', url['url']]), 1)
+          in_flight[pool.submit(self.requests_fetch, url)] = url
+          self.data['in_flight'].add(url['url'])
+          if delay:
+            time.sleep(delay)
+        if not in_flight:
+          break
+        done, pending = wait(in_flight, return_when = FIRST_COMPLETED)
+        for future in done:
+          url = in_flight.pop(future)
+          self.data['in_flight'].discard(url['url'])
           if self.z_obj.debug_mode:
-            self.crawl_url(url, typ, domain_id)
+            req, load_time = future.result()
+            self.requests_store(url, typ, domain_id, req, load_time)
           else:
             try:
-              self.crawl_url(url, typ, domain_id)
+              req, load_time = future.result()
+              self.requests_store(url, typ, domain_id, req, load_time)
+              self.data['error_count'] = 0
+            except:
+              self.crawl_error(url, typ)
+          self.data['url_counts'][typ] += 1
+          self.data['url_counts']['total'] += 1
+          # Write any uncommitted data
+          self.z_obj.com()
+    return i
+
+  # Crawl one URL type with the browser pool, one page per browser at a time.
+  # Pages are loaded, and the Selenium plugins run, in the worker threads.
+  # Pages are stored and their links added here, as in crawl_threaded.
+  def crawl_browsers(self, typ, domain_id, i, crawl_start, crawl_start_all):
+    delay = self.calculate_delay(self.settings['crawler']['req_delay']['method'], self.settings['crawler']['req_delay']['time'])
+    idle = list(range(len(self.data['browsers'])))
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers = len(idle)) as pool:
+      while True:
+        # Give each idle browser a page. Pages in flight count against max_links.
+        while idle and self.data['urls_to_crawl'][typ] \
+        and self.within_limits(typ, crawl_start, crawl_start_all, len(in_flight)):
+          i += 1
+          url = self.next_url(typ)
+          self.z_obj.pprint(''.join(["Crawling #", str(i), ': ', url['url']]), 1)
+          uid = self.get_url_id(url['url'], domain_id)
+          index = idle.pop()
+          in_flight[pool.submit(self.selenium_pool_fetch, url, uid, index)] = (url, uid, index)
+          self.data['in_flight'].add(url['url'])
+          if delay:
+            time.sleep(delay)
+        if not in_flight:
+          break
+        done, pending = wait(in_flight, return_when = FIRST_COMPLETED)
+        for future in done:
+          url, uid, index = in_flight.pop(future)
+          self.data['in_flight'].discard(url['url'])
+          if self.z_obj.debug_mode:
+            req_text, load_time = future.result()
+            self.selenium_store(url, typ, domain_id, uid, req_text, load_time)
+          else:
+            try:
+              req_text, load_time = future.result()
+              self.selenium_store(url, typ, domain_id, uid, req_text, load_time)
               self.data['error_count'] = 0
             except:
-              self.data['error_count'] += 1
-              self.z_obj.pprint('Crawl Error ' + str(self.data['error_count']), 0)
-              # Add the url back into the queue if we have that option set
-              if self.settings['crawler']['retry_on_error']:
-                self.data['urls_to_crawl'][typ].append(url)
-              # Sometimes the issue is the browser failing. This will fix it.
-              self.restart_browser()
-              if self.data['error_count'] >= self.settings['error_max']:
-                # We are probably going to crash. Save everything!
-                self.shutdown()
-                # Since shutdown() turns off the Selenium Browser, we need to turn it back on in this case:
-                if self.settings['crawler']['req_method'] == 'selenium':
-                  self.initiate_browser()
-                # Turn on debug mode.
-                # You are probably going to crash: usually you are here
-                # because something went wrong and isn't self-correcting.
-                self.z_obj.debug_mode = True
+              self.crawl_error(url, typ, index)
+          idle.append(index)
           self.data['url_counts'][typ] += 1
           self.data['url_counts']['total'] += 1
           # Write any uncommitted data
           self.z_obj.com()
-          time.sleep(self.calculate_delay(self.settings['crawler']['req_delay']['method'], self.settings['crawler']['req_delay']['time']))
+    return i
+
+  # Save uncrawled URLs if need be. A persistent frontier is already saved.
+  # Any earlier save from this run is replaced.
+  def save_uncrawled(self):
+    if self.settings['save_uncrawled'] and not self.settings['persistent_frontier']:
+      self.z_obj.excom('CREATE TABLE IF NOT EXISTS uncrawled_urls (url text, type text, depth int)')
+      self.z_obj.ex('DELETE FROM uncrawled_urls')
+      for typ in sorted(self.data['urls_to_crawl'], reverse = True):
+        uncrawled = [(url['url'], typ, url['depth']) for url in self.data['urls_to_crawl'][typ]]
+        if uncrawled:
+          self.z_obj.exm('INSERT INTO uncrawled_urls VALUES (?,?,?)', uncrawled)
+
+  # Save the crawl so far without stopping it: wait for the storage thread to
+  # write the pages it has, then save the uncrawled URLs and commit.
+  def save_progress(self):
+    if self.data['storage_thread']:
+      self.data['storage_queue'].join()
+    self.check_storage()
+    self.save_uncrawled()
+    self.z_obj.com(True)
 
   ## Write the uncrawled URLs to fill for later parsing
   def shutdown(self):
-    # We are done crawling at this point, so shut the browser down.
+    # Finish writing any pages still waiting for storage
+    self.stop_storage()
+    # We are done crawling at this point, so shut the browsers down.
     if self.settings['crawler']['req_method'] == 'selenium':
-      self.browser.quit()
-    # Save uncrawled URLs if need be:
-    if self.settings['save_uncrawled']:
-      self.z_obj.excom('CREATE TABLE IF NOT EXISTS uncrawled_urls (url text, type text, depth int)')
-      for typ in sorted(self.data['urls_to_crawl'], reverse = True):
-        for url in self.data['urls_to_crawl'][typ]:
-          self.z_obj.ex('INSERT INTO uncrawled_urls VALUES (?,?,?)',(url['url'], typ, url['depth']))
-      self.z_obj.com()
+      for browser in self.data['browsers']:
+        browser.quit()
+    self.save_uncrawled()
+    self.z_obj.com()
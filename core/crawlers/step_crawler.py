@@ -1,8 +1,13 @@
 import json
+import copy
 import hashlib
+import itertools
+import queue
+import threading
 import random
 import requests
 import time
+from urllib.parse import urlsplit
 from selenium import webdriver
 from bs4 import BeautifulSoup
 
@@ -34,6 +39,36 @@ class StepCrawler():
   settings['crawler'] = {}
   settings['crawler']['selenium_browser'] = 'Firefox'
   settings['crawler']['selenium_browser_path'] = False
+  # Keep the browser between step sets instead of starting a new one for each.
+  # Between step sets, cookies and storage are cleared for every site the last
+  # set visited, and the browser goes to about:blank. recycle_after starts a
+  # fresh browser after that many step sets anyway. 0 never recycles it.
+  settings['crawler']['reuse_browser'] = False
+  settings['crawler']['recycle_after'] = 50
+  # Run the step sets as a prefix tree, depth first, so steps shared by the
+  # start of several step sets run once. At each fork, the browser's URL,
+  # cookies and storage are saved. Before each other branch, every site
+  # visited so far is cleared as between step sets, and the fork page's
+  # cookies and storage are put back. Cookies and storage the shared steps
+  # left on other sites are not. A branch that stays on the fork page would
+  # lose the page's state, like typed inputs, so the shared steps are
+  # replayed for it instead, without recording their data again.
+  # The data recorded by a shared step is saved for every step set through it.
+  # This always reuses the browser, resetting it between first steps.
+  settings['crawler']['prefix_tree'] = False
+  # Step sets are generated as they are needed, and written to the database
+  # batch_size at a time. With prefix_tree, each batch is one tree.
+  settings['crawler']['batch_size'] = 1000
+  # Start after the last step set completed by an earlier run with the same
+  # steps and variants, instead of from the first
+  settings['crawler']['resume'] = False
+  # Number of browsers running step sets at once. Each worker thread has its
+  # own browser, and takes step sets from a shared queue. With prefix_tree,
+  # each worker takes an equal part of the batch as its own tree. All of the
+  # workers' data is written to the database from the crawl thread. A failed
+  # step set is logged with its index and the crawl goes on. Until the next
+  # batch, the resume cursor stays at the first failed step set of the batch.
+  settings['crawler']['workers'] = 1
 
   # Extra plugins for acting when the Selenium Browser is open
   selenium_plugins = {}
@@ -43,13 +78,27 @@ class StepCrawler():
 
   # Local data dict
   data = {}
-  data['step_sets'] = []
-  # DB cache - mainly meant to cache domain/URL IDs so we don't have to do select statements
-  data['cache'] = {}
-  data['cache']['domains'] = {}
-  data['cache']['step_sets'] = {}
-  data['cache']['steps'] = {}
-  data['cache']['urls'] = {}
+  # Prefix tree of the current batch of step sets, for the prefix_tree setting.
+  # Each node has its step, the step IDs of the step sets through it, and its
+  # children by step hash.
+  data['step_tree'] = None
+  # Step sets run in the current browser, for recycle_after
+  data['browser_uses'] = 0
+  # Worker copies of the crawler, when there is more than one worker. In a
+  # worker, 'writer' is the queue its data goes to.
+  data['workers'] = []
+  data['writer'] = None
+  # Resume cursor tracking for the workers' current batch: the next step set
+  # the cursor is waiting on, step sets done after it, and the first step set
+  # of each failed job
+  data['next_set'] = 0
+  data['completed'] = set()
+  data['failed'] = set()
+  # Set to stop the workers, e.g. on KeyboardInterrupt. Shared with them.
+  data['stop'] = None
+  # Sites visited by the current step set, origin: a URL there. Used to reset
+  # the browser for the next step set.
+  data['origins'] = {}
 
   ##############################################################################
   # Helper Functions
@@ -81,30 +130,35 @@ class StepCrawler():
   ###########
   # URL Functions
 
-  # Get the database id for a domain. Try the cache first, then select, and finally create.
+  # Get the database id for a domain. Try the shared id cache first, then select, and finally create.
   def get_domain_id(self, string, recursed = False):
-    if string in self.data['cache']['domains']:
-      return self.data['cache']['domains'][string]
+    d = self.z_obj.id_cache['domains'].get(string)
+    if d:
+      return d
     else:
       d = self.z_obj.fetchone('select rowid from domains where domain=?', (string,))
       if d:
+        self.z_obj.id_cache['domains'].put(string, d[0])
         return d[0]
       else:
         self.z_obj.ex('insert into domains values (?,NULL,NULL)',(string, ))
         if self.z_obj.cursor.lastrowid:
+          self.z_obj.id_cache['domains'].put(string, self.z_obj.cursor.lastrowid)
           return self.z_obj.cursor.lastrowid
         elif not recursed:
           return self.get_domain_id(string, True)
         else:
           return None
 
-  # Get the database id for a url. Try the cache first, then select, and finally create.
+  # Get the database id for a url. Try the shared id cache first, then select, and finally create.
   def get_url_id(self, string, recursed = False):
-    if string in self.data['cache']['urls']:
-      return self.data['cache']['urls'][string]
+    d = self.z_obj.id_cache['urls'].get(string)
+    if d:
+      return d
     else:
       d = self.z_obj.fetchone('select rowid from urls where url=?', (string,))
       if d:
+        self.z_obj.id_cache['urls'].put(string, d[0])
         return d[0]
       else:
         # We don't he the URL info. In this crawler, we may not have the domain either, so grab it now
@@ -116,6 +170,7 @@ class StepCrawler():
           # Now, insert our data
           self.z_obj.ex('insert into urls values (?,?)',(string, domain_id,))
           if self.z_obj.cursor.lastrowid:
+            self.z_obj.id_cache['urls'].put(string, self.z_obj.cursor.lastrowid)
             return self.z_obj.cursor.lastrowid
           elif not recursed:
             return self.get_url_id(string, True)
@@ -133,29 +188,6 @@ class StepCrawler():
     else:
       return None
 
-  ###########
-  # Step data Functions
-
-  # Get the database id for an element, searching by hash. If the hash isn't found, add to DB
-  def get_step_set_id(self, hsh):
-    d = self.z_obj.fetchone('select rowid from step_crawler_step_sets where hash=? and zeomine_instance=?', (hsh,self.z_obj.run_id))
-    if d:
-      return d[0]
-    else:
-      self.z_obj.excom('insert into step_crawler_step_sets values (?,?)',(self.z_obj.run_id,hsh,))
-      self.data['cache'][hsh] = self.z_obj.cursor.lastrowid
-      return self.z_obj.cursor.lastrowid
-
-  # Get the database id for an element, searching by hash. If the hash isn't found, add to DB
-  def get_step_id(self, hsh, stepsetid):
-    d = self.z_obj.fetchone('select rowid from step_crawler_steps where hash=? and step_set=? and zeomine_instance=?', (hsh,stepsetid,self.z_obj.run_id))
-    if d:
-      return d[0]
-    else:
-      self.z_obj.excom('insert into step_crawler_steps values (?,?)',(self.z_obj.run_id,hsh,))
-      self.data['cache'][hsh] = self.z_obj.cursor.lastrowid
-      return self.z_obj.cursor.lastrowid
-
   ###########
   # Generate the step sets
 
@@ -194,37 +226,181 @@ class StepCrawler():
         return_list.append({'url': url, 'actions': actions})
     return return_list
 
-  # TODO: Add recording of all steps/variants
-  def generate_steps(self):
-    step_sets = []
+  # Variants for each valid step, as (step, step hash, str(step)) tuples
+  def step_variants(self):
+    variants = []
     for step in self.settings['steps']:
       if self.validate_step(step):
-        # Take the existing list of step sets, and attach variants by creating new steps
-        add_set = self.generate_variable_set(step)
-        new_sets = []
-        for aset in add_set:
-          if step_sets:
-            for step_set in step_sets:
-              new_sets.append(step_set + [aset])
-          else:
-            new_sets.append([aset])
-        step_sets = new_sets
-    # Write step sets to database
-    for step_set in step_sets:
-      h = hashlib.sha256(str(step_set).encode()).hexdigest()
-      self.z_obj.ex('INSERT INTO step_crawler_step_sets VALUES(?,?)',(self.z_obj.run_id, h))
-      stepsetid = self.z_obj.cursor.lastrowid
-      for step in step_set:
-        data = (self.z_obj.run_id, )
-        data += (stepsetid,)
-        h = hashlib.sha256(str(step).encode()).hexdigest()
-        data += (h,)
-        data += (self.get_url_id(step['url']),)
-        data += (str(step['actions']),)
-        self.z_obj.ex('INSERT INTO step_crawler_steps VALUES(?,?,?,?,?)',data)
-      self.z_obj.com()
-        
-    return step_sets
+        add_set = []
+        for aset in self.generate_variable_set(step):
+          r = str(aset)
+          add_set.append((aset, hashlib.sha256(r.encode()).hexdigest(), r))
+        variants.append(add_set)
+    return variants
+
+  # Generate the step sets one at a time, from the start-th on: every
+  # combination of the steps' variants, with earlier steps varying fastest.
+  # With prefix_tree, the last step varies fastest instead, so each batch
+  # covers as few first steps as it can and its tree shares the most steps.
+  # Yields (index, step set, step hashes, step set hash). Each step is only
+  # hashed once, and the step set hash is built from the steps' strings, the
+  # same as hashing str(step_set).
+  # TODO: Add recording of all steps/variants
+  def generate_steps(self, start = 0):
+    variants = self.step_variants()
+    if not variants:
+      return
+    last_fastest = self.settings['crawler']['prefix_tree']
+    combos = itertools.product(*variants) if last_fastest else itertools.product(*reversed(variants))
+    for index, combo in enumerate(itertools.islice(combos, start, None), start):
+      if not last_fastest:
+        combo = combo[::-1]
+      h = hashlib.sha256(('[' + ', '.join([c[2] for c in combo]) + ']').encode()).hexdigest()
+      yield index, [c[0] for c in combo], [c[1] for c in combo], h
+
+  # Group the generated step sets into batches of batch_size
+  def step_set_batches(self, start = 0):
+    size = max(1, int(self.settings['crawler']['batch_size']))
+    batch = []
+    for item in self.generate_steps(start):
+      batch.append(item)
+      if len(batch) >= size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  # Write a batch of step sets and their steps to the database. Returns the
+  # batch as (index, step set, step hashes, step IDs), so the steps can be
+  # run without looking their IDs up again.
+  def save_step_sets(self, batch):
+    run_id = self.z_obj.run_id
+    self.z_obj.exm('INSERT INTO step_crawler_step_sets (zeomine_instance, hash, set_index) VALUES (?,?,?)', [(run_id, item[3], item[0]) for item in batch])
+    ids = dict(self.z_obj.fetchall('SELECT set_index, rowid FROM step_crawler_step_sets WHERE zeomine_instance=? AND set_index>=? AND set_index<=? ORDER BY rowid', (run_id, batch[0][0], batch[-1][0])))
+    steps = []
+    for index, step_set, hashes, h in batch:
+      for step, sh in zip(step_set, hashes):
+        steps.append((run_id, ids[index], sh, self.get_url_id(step['url']), str(step['actions'])))
+    self.z_obj.exm('INSERT INTO step_crawler_steps VALUES(?,?,?,?,?)', steps)
+    # The new rows come back in the order they were written
+    step_ids = (row[0] for row in self.z_obj.iterquery('SELECT rowid FROM step_crawler_steps WHERE zeomine_instance=? AND step_set>=? AND step_set<=? ORDER BY rowid', (run_id, min(ids.values()), max(ids.values()))))
+    saved = [(index, step_set, hashes, list(itertools.islice(step_ids, len(step_set)))) for index, step_set, hashes, h in batch]
+    self.z_obj.com()
+    return saved
+
+  ###########
+  # Resume cursor
+
+  # Key for the resume cursor: a hash of the step settings and the order
+  # they are generated in, so a cursor is only used for the same step sets
+  def cursor_key(self):
+    conf = [self.settings['steps'], self.settings['url_variants'], self.settings['action_variants'], bool(self.settings['crawler']['prefix_tree'])]
+    return hashlib.sha256(json.dumps(conf, sort_keys=True).encode()).hexdigest()
+
+  # Index of the first step set that hasn't been completed
+  def get_cursor(self):
+    row = self.z_obj.fetchone('SELECT next_set FROM step_crawler_cursor WHERE config=?', (self.cursor_key(),))
+    return row[0] if row else 0
+
+  def set_cursor(self, next_set):
+    self.z_obj.ex('INSERT OR REPLACE INTO step_crawler_cursor VALUES (?,?)', (self.cursor_key(), next_set))
+
+  # Build the prefix tree of a batch from save_step_sets. Step sets that start
+  # with the same steps share the nodes for those steps.
+  def build_step_tree(self, batch):
+    root = {'step': None, 'step_ids': [], 'children': {}}
+    for index, step_set, hashes, step_ids in batch:
+      node = root
+      for step, h, stepid in zip(step_set, hashes, step_ids):
+        if h not in node['children']:
+          node['children'][h] = {'step': step, 'step_ids': [], 'children': {}}
+        node = node['children'][h]
+        node['step_ids'].append(stepid)
+    return root
+
+  ###########
+  # Browser
+
+  # Start a browser
+  def initiate_browser(self):
+    path = self.settings['crawler']['selenium_browser_path']
+    if path:
+      brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])(path)
+      self.browser = brow
+    else:
+      brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])()
+      self.browser = brow
+    self.data['origins'] = {}
+
+  # Note the site the browser is on, so reset_browser can clear it
+  def record_origin(self):
+    u = urlsplit(self.browser.current_url)
+    if u.scheme in ['http', 'https'] and u.netloc:
+      self.data['origins'][u.scheme + '://' + u.netloc] = self.browser.current_url
+
+  # Clear cookies and storage for each site visited since the last reset, and
+  # go to about:blank. Cookies and storage can only be cleared for the site
+  # the browser is on, so other sites are visited again. Returns False if the
+  # browser could not be reset, and should be replaced.
+  def reset_browser(self):
+    try:
+      current = urlsplit(self.browser.current_url)
+      current = current.scheme + '://' + current.netloc
+      # Start with the site we are on, as it doesn't need a page load
+      for origin in sorted(self.data['origins'], key = lambda o: o != current):
+        if origin != current:
+          self.browser.get(self.data['origins'][origin])
+        self.browser.delete_all_cookies()
+        self.browser.execute_script('window.localStorage.clear(); window.sessionStorage.clear();')
+      self.browser.get('about:blank')
+      self.data['origins'] = {}
+      return True
+    except Exception as e:
+      self.z_obj.pprint('Failed to reset browser: ' + str(e), 1)
+      return False
+
+  # Save the browser's URL, cookies and storage for the site it is on
+  def snapshot_browser(self):
+    snapshot = {'url': self.browser.current_url, 'cookies': [], 'storage': None}
+    if urlsplit(snapshot['url']).scheme in ['http', 'https']:
+      snapshot['cookies'] = self.browser.get_cookies()
+      try:
+        snapshot['storage'] = self.browser.execute_script('return [JSON.stringify(window.localStorage), JSON.stringify(window.sessionStorage)];')
+      except:
+        pass
+    return snapshot
+
+  # Put back a snapshot from snapshot_browser. Every site visited since is
+  # cleared first, so nothing a branch left behind leaks into the next one.
+  # Cookies and storage can only be set on their site, so go there first. The
+  # page is reloaded once they are set, unless the next step is about to load
+  # a different URL anyway.
+  def restore_browser(self, snapshot, next_url = None):
+    self.reset_browser()
+    if urlsplit(snapshot['url']).scheme not in ['http', 'https']:
+      return
+    self.browser.get(snapshot['url'])
+    for cookie in snapshot['cookies']:
+      try:
+        self.browser.add_cookie(cookie)
+      except Exception as e:
+        self.z_obj.pprint('Failed to restore cookie ' + str(cookie.get('name')) + ': ' + str(e), 1)
+    if snapshot['storage']:
+      self.browser.execute_script('var s = [window.localStorage, window.sessionStorage];'
+        + 'for (var i = 0; i < 2; i++) { var d = JSON.parse(arguments[i]); s[i].clear(); for (var k in d) { s[i].setItem(k, d[k]); } }',
+        snapshot['storage'][0], snapshot['storage'][1])
+    if next_url is None or next_url == self.browser.current_url:
+      self.browser.get(snapshot['url'])
+    self.record_origin()
+
+  # Shut the browser down
+  def quit_browser(self):
+    if self.browser:
+      try:
+        self.browser.quit()
+      except:
+        self.z_obj.pprint('Failed to quit browser', 0)
+      self.browser = None
 
   ###########
   # Broswer actions to execute
@@ -279,27 +455,77 @@ class StepCrawler():
 
 
   # Get data with Selenium module
-  def walk_steps(self, step_set):
-    h = hashlib.sha256(str(step_set).encode()).hexdigest()
-    stepsetid = self.get_step_set_id(h)
-    for step in step_set:
-      h = hashlib.sha256(str(step).encode()).hexdigest()
-      stepid = self.get_step_id(h, stepsetid)
-      # Check if we are already at the listed URL. If not, go there
-      if self.browser.current_url != step['url']:
-        self.browser.get(step['url'])
-      # Loop through the action set and do one at a time, entering data as we go
-      for action in step['actions']:
-        index = int(step['actions'].index(action))
-        data = str(self.execute_action(action, index))
-        act = (self.z_obj.run_id, )
-        act += (stepid, )
-        act += (index, )
-        act += (str(action), )
-        act += (data, )
-        self.z_obj.ex('INSERT INTO step_crawler_data VALUES (?,?,?,?,?)', act)
-      # Commit the data at the end of each step
-      self.z_obj.com()
+  def walk_steps(self, step_set, step_ids):
+    for step, stepid in zip(step_set, step_ids):
+      self.run_step(step, [stepid])
+
+  # Run one step, and save its data under each of the given step IDs
+  def run_step(self, step, stepids):
+    # Workers stop at their next step when the crawl is stopped
+    if self.data['stop'] and self.data['stop'].is_set():
+      raise RuntimeError('Step crawler stopped')
+    # Check if we are already at the listed URL. If not, go there
+    if self.browser.current_url != step['url']:
+      self.browser.get(step['url'])
+    self.record_origin()
+    # Loop through the action set and do one at a time, entering data as we go
+    act = []
+    for action in step['actions']:
+      index = int(step['actions'].index(action))
+      data = str(self.execute_action(action, index))
+      for stepid in stepids:
+        act.append((self.z_obj.run_id, stepid, index, str(action), data))
+    # Actions can move to another site, e.g. by clicking a link
+    self.record_origin()
+    self.save_data(act)
+
+  # Save step_crawler_data rows. Workers hand them to the crawl thread instead.
+  def save_data(self, rows):
+    if self.data['writer']:
+      self.data['writer'].put(('rows', rows))
+      return
+    self.z_obj.exm('INSERT INTO step_crawler_data VALUES (?,?,?,?,?)', rows)
+    # Commit the data at the end of each step
+    self.z_obj.com()
+
+  # Run a step again to get the browser back to the state it left, without
+  # recording anything. Only the actions that change the page are run.
+  def replay_step(self, step):
+    if self.browser.current_url != step['url']:
+      self.browser.get(step['url'])
+    self.record_origin()
+    for index, action in enumerate(step['actions']):
+      verb = action if isinstance(action, str) else list(action)[0]
+      if verb in ['click', 'delete_cookies']:
+        self.execute_action(action, index)
+    self.record_origin()
+
+  # Run the step sets below a node of the step tree, depth first. path is the
+  # steps from the first one down to node. The browser state is saved before
+  # the first branch of a fork, and put back before each of the others. A
+  # branch that stays on the fork page replays path instead, as reloading the
+  # page would lose its state.
+  def walk_tree(self, node, path):
+    children = list(node['children'].values())
+    fork_url = self.browser.current_url
+    snapshot = None
+    if any(child['step']['url'] != fork_url for child in children[1:]):
+      snapshot = self.snapshot_browser()
+    for i, child in enumerate(children):
+      if i and child['step']['url'] == fork_url:
+        self.reset_browser()
+        for step in path:
+          self.replay_step(step)
+      elif i:
+        self.restore_browser(snapshot, child['step']['url'])
+      self.run_step(child['step'], child['step_ids'])
+      self.walk_tree(child, path + [child['step']])
+
+  # Count the step sets below a node
+  def count_leaves(self, node):
+    if not node['children']:
+      return 1
+    return sum(self.count_leaves(child) for child in node['children'].values())
 
   ##############################################################################
   # Zeomine plugins
@@ -324,26 +550,175 @@ class StepCrawler():
     self.z_obj.pprint('Successfully loaded StepCrawler.', 2, 2)
 
   def initiate(self):
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS step_crawler_step_sets (zeomine_instance text, hash text)')
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS step_crawler_steps (zeomine_instance text, step_set int, hash text, url int, actions text)')
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS step_crawler_data (zeomine_instance text, step int, action_index int, action text, data text)')
-    self.data['step_sets'] = self.generate_steps()
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS step_crawler_step_sets (zeomine_instance text, hash text)',
+      'CREATE TABLE IF NOT EXISTS step_crawler_steps (zeomine_instance text, step_set int, hash text, url int, actions text)',
+      'CREATE TABLE IF NOT EXISTS step_crawler_data (zeomine_instance text, step int, action_index int, action text, data text)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS step_crawler_step_sets_instance_hash ON step_crawler_step_sets (zeomine_instance, hash)',
+      'CREATE INDEX IF NOT EXISTS step_crawler_steps_instance_set_hash ON step_crawler_steps (zeomine_instance, step_set, hash)',
+      'CREATE INDEX IF NOT EXISTS step_crawler_data_instance_step ON step_crawler_data (zeomine_instance, step)',
+    ])
+    migrations.append([
+      'ALTER TABLE step_crawler_step_sets ADD COLUMN set_index int',
+      'CREATE INDEX IF NOT EXISTS step_crawler_step_sets_instance_index ON step_crawler_step_sets (zeomine_instance, set_index)',
+      'CREATE TABLE IF NOT EXISTS step_crawler_cursor (config text, next_set int)',
+      'CREATE UNIQUE INDEX IF NOT EXISTS step_crawler_cursor_config ON step_crawler_cursor (config)',
+    ])
+    self.z_obj.migrate('StepCrawler', migrations)
+
+  # Run one step set in the browser, saving data under the given step IDs
+  def crawl_step_set(self, step_set, step_ids):
+    recycle_after = self.settings['crawler']['recycle_after']
+    if not self.browser:
+      self.initiate_browser()
+      self.data['browser_uses'] = 0
+    # Walk through the steps:
+    self.walk_steps(step_set, step_ids)
+    self.data['browser_uses'] += 1
+    # We are done. Reset the browser for the next step set, or close it
+    if not self.settings['crawler']['reuse_browser'] or (recycle_after and self.data['browser_uses'] >= recycle_after) or not self.reset_browser():
+      self.quit_browser()
+
+  # Run a tree of step sets in the browser
+  def crawl_tree(self, tree):
+    recycle_after = self.settings['crawler']['recycle_after']
+    # Each first step starts from a clean browser. Recycling is only checked here.
+    for node in tree['children'].values():
+      if self.browser and ((recycle_after and self.data['browser_uses'] >= recycle_after) or not self.reset_browser()):
+        self.quit_browser()
+      if not self.browser:
+        self.initiate_browser()
+        self.data['browser_uses'] = 0
+      self.run_step(node['step'], node['step_ids'])
+      self.walk_tree(node, [node['step']])
+      self.data['browser_uses'] += self.count_leaves(node)
+
+  ###########
+  # Worker pool
+
+  # A copy of the crawler for a worker thread, with its own browser. The
+  # settings are shared. Its data goes to the writer queue.
+  def new_worker(self, writer):
+    worker = copy.copy(self)
+    worker.browser = None
+    worker.data = dict(self.data)
+    worker.data['origins'] = {}
+    worker.data['browser_uses'] = 0
+    worker.data['workers'] = []
+    worker.data['writer'] = writer
+    return worker
+
+  # Worker thread: run jobs from the queue until it is empty, or the crawl is
+  # stopped. A job is a list of batch items, reported back as done once all of
+  # them have run.
+  def step_worker(self, jobs):
+    try:
+      while not self.data['stop'].is_set():
+        try:
+          items = jobs.get_nowait()
+        except queue.Empty:
+          break
+        try:
+          if self.settings['crawler']['prefix_tree']:
+            self.crawl_tree(self.build_step_tree(items))
+          else:
+            for item in items:
+              self.crawl_step_set(item[1], item[3])
+          self.data['writer'].put(('done', [item[0] for item in items]))
+        except Exception as e:
+          if not self.data['stop'].is_set():
+            self.data['writer'].put(('error', items[0][0], str(e)))
+          self.quit_browser()
+        except BaseException:
+          self.data['writer'].put(('error', items[0][0], 'worker stopped'))
+          raise
+    finally:
+      # The crawl thread waits for every worker to say it has stopped
+      self.data['writer'].put(('exit', None))
+
+  # Run a batch across the workers. Their data is written here as it comes in.
+  # Step sets can finish out of order, so the cursor only moves past a step
+  # set once every one before it is done. It stops at the first failed step
+  # set of the batch, so a run stopped before the next batch tries it again.
+  # If the crawl thread is interrupted, the workers are stopped and joined
+  # before the error goes on, so their browsers are not shut down under them.
+  def crawl_batch_parallel(self, batch, writer):
+    self.data['next_set'] = batch[0][0]
+    self.data['completed'] = set()
+    self.data['failed'] = set()
+    jobs = queue.Queue()
+    if self.settings['crawler']['prefix_tree']:
+      size = -(-len(batch) // len(self.data['workers']))
+      for i in range(0, len(batch), size):
+        jobs.put(batch[i:i + size])
+    else:
+      for item in batch:
+        jobs.put([item])
+    threads = [threading.Thread(target = worker.step_worker, args = (jobs,), daemon = True) for worker in self.data['workers']]
+    for thread in threads:
+      thread.start()
+    running = len(threads)
+    try:
+      while running:
+        msg = writer.get()
+        if msg[0] == 'rows':
+          self.z_obj.exm('INSERT INTO step_crawler_data VALUES (?,?,?,?,?)', msg[1])
+          self.z_obj.com()
+        elif msg[0] == 'done':
+          self.data['completed'].update(msg[1])
+          if self.data['next_set'] in self.data['completed']:
+            while self.data['next_set'] in self.data['completed']:
+              self.data['completed'].remove(self.data['next_set'])
+              self.data['next_set'] += 1
+            self.set_cursor(self.data['next_set'])
+        elif msg[0] == 'error':
+          # A failed step set is never completed, so the cursor stops at the first one
+          self.data['failed'].add(msg[1])
+          self.z_obj.pprint('Step set error at ' + str(msg[1]) + ': ' + msg[2], 0)
+        else:
+          running -= 1
+      if self.data['failed']:
+        self.z_obj.pprint(str(len(self.data['failed'])) + ' failed jobs in this batch. Resume cursor at step set ' + str(min(self.data['failed'])), 0)
+    finally:
+      if running:
+        self.data['stop'].set()
+      for thread in threads:
+        thread.join()
 
   def crawl(self):
-    for step_set in self.data['step_sets']:
-      # We create a new browser for each step set
-      path = self.settings['crawler']['selenium_browser_path']
-      if path:
-        brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])(path)
-        self.browser = brow
+    start = 0
+    if self.settings['crawler']['resume']:
+      start = self.get_cursor()
+      if start:
+        self.z_obj.pprint('Resuming at step set ' + str(start), 1)
+    writer = None
+    if int(self.settings['crawler']['workers']) > 1:
+      writer = queue.Queue()
+      self.data['stop'] = threading.Event()
+      self.data['workers'] = [self.new_worker(writer) for i in range(int(self.settings['crawler']['workers']))]
+    for batch in self.step_set_batches(start):
+      batch = self.save_step_sets(batch)
+      if writer:
+        self.crawl_batch_parallel(batch, writer)
+      elif self.settings['crawler']['prefix_tree']:
+        self.data['step_tree'] = self.build_step_tree(batch)
+        self.crawl_tree(self.data['step_tree'])
+        self.set_cursor(batch[-1][0] + 1)
       else:
-        brow = getattr(webdriver, self.settings['crawler']['selenium_browser'])()
-        self.browser = brow
-      # Walk through the steps:
-      self.walk_steps(step_set)
-      # We are done. Close the browser
-      self.browser.quit()
+        for item in batch:
+          self.crawl_step_set(item[1], item[3])
+          self.set_cursor(item[0] + 1)
+      # Commit the cursor with the batch's data, so a resumed run picks up here
+      self.z_obj.com(True)
+    self.quit_browser()
+    for worker in self.data['workers']:
+      worker.quit_browser()
 
   ## Shut down
   def shutdown(self):
-    pass
+    self.quit_browser()
+    for worker in self.data['workers']:
+      worker.quit_browser()
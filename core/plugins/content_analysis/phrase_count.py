@@ -1,41 +1,77 @@
-## Word Count
+import hashlib
+import heapq
+import json
+from collections import Counter
+from core.utilities.zeomine_sketch import make_counter
+from core.utilities.zeomine_tokenizer import Tokenizer
+
+## Phrase Count
 #
-class WordCount():
+# Counts phrases of n consecutive words in extracted text. Words are found as
+# in WordCount, and a phrase never spans two extracted texts. Run reports can
+# use a memory-bounded algorithm, so counts over a very large crawl fit in a
+# fixed budget. URL reports are counted exactly, one URL at a time.
+class PhraseCount():
   ##############################################################################
   # Plugin Settings
   ##############################################################################
-  
-  # Define the parent ZSM object so we can call its functions and access its 
+
+  # Define the parent ZSM object so we can call its functions and access its
   # data. Set this in load_config
   z_obj = None
-  
+
   # Settings dict
   settings = {}
-  
+
   # The type of report to generate. This is a list with 'run' for an
   # entire Zeomine run, 'url' for a per-url count, or both
   settings['report_type'] = ['run']
-  
-  # run_id is the run ID of the Zeomine instance you want to perform the 
-  # analysis on. Set to the integer value, 'current' to get the current run,
-  # or 'previous' to get the previous run.
+
+  # run_id is the run ID of the Zeomine instance you want to perform the
+  # analysis on. Set to the UUID, 'current' to get the current run, or
+  # 'previous' to get the run before the current one.
   settings['run_id'] = 'current'
-  
+
   # The selector from text_extraction, or False if you want to include everything.
   settings['selector'] = False
-  
-  # List of words to not include in our report.
+
+  # Number of words in a phrase
+  settings['n'] = 2
+
+  # List of words to not include in phrases. Phrases are made from the words
+  # left over.
   settings['blacklist'] = [] # Example: ['a', 'an', 'the']
-  
+
   # List of substrings to remove from found words, usually punctuation
-  settings['cleanup_list'] = [':', ';', '--', '?', '&', '.', '!', ',', '"', '”', '“', '‘','’', '(', ')']
-  
+  settings['cleanup_list'] = [':', ';', '--', '?', '&', '.', '!', ',', '"', '”', '“', '‘','’', '(', ')', "'"]
+
   # Minimum length of words to include
   settings['min_length'] = 1
 
+  # How to count phrases for the run report:
+  # - 'exact': count every phrase. Memory grows with the number of distinct
+  #   phrases.
+  # - 'space_saving': keep counts for at most 'capacity' phrases. Common
+  #   phrases are kept, and counts can be slightly too high.
+  # - 'count_min': a count-min sketch of 'width' x 'depth' counters, keeping
+  #   the 'capacity' phrases with the highest estimates. Counts can be
+  #   slightly too high.
+  settings['counting'] = {}
+  settings['counting']['algorithm'] = 'exact'
+  settings['counting']['capacity'] = 100000
+  settings['counting']['width'] = 200000
+  settings['counting']['depth'] = 4
+
+  # Limit reporting to a maximum number of phrases, a minimum fraction, or
+  # minimum normalized fraction. Set to False for no limit.
+  settings['report_limit'] = {}
+  settings['report_limit']['max_phrases'] = False
+  settings['report_limit']['fraction'] = False
+  settings['report_limit']['normalized_fraction'] = False
+
   # Local data dict
   data = {}
-  data['word_count'] = {'run': {}, 'url': {}}
+  data['phrase_count'] = {'run': None, 'total': 0}
 
   ##############################################################################
   # Helper Functions
@@ -44,38 +80,46 @@ class WordCount():
   ###########
   # Common data functions
 
-  # Check against whitelist: item contains a matching substring
-  def in_whitelist(self, item, whitelist):
-    if not whitelist:
-      return True
-    else:
-      for substr in whitelist:
-        if substr in item:
-          return True
-      return False
-
-  # Check against blacklist: item does not contain a matching substring
-  def in_blacklist(self, item, blacklist):
-    if not blacklist:
-      return False
+  # Get the phrases in an extracted text, in order
+  def phrases(self, tokenizer, text):
+    words = [w for w in tokenizer.words(text) if w]
+    n = max(1, int(self.settings['n']))
+    if n == 1:
+      return words
+    return [' '.join(words[i:i + n]) for i in range(len(words) - n + 1)]
+
+  # Watermark key for this plugin. Reports are only rebuilt when there is new
+  # text, or the settings have changed.
+  def watermark_key(self):
+    conf = [self.settings['selector'], self.settings['n'], self.settings['blacklist'], self.settings['cleanup_list'], self.settings['min_length'],
+      sorted(self.settings['report_type']), self.settings['counting'], self.settings['report_limit']]
+    return 'PhraseCount:' + hashlib.md5(json.dumps(conf, sort_keys=True).encode()).hexdigest()
+
+  # Replace the report for a URL (0 for the whole run) with one built from
+  # counts. total is the number of phrases counted, which is more than the sum
+  # of counts if some were dropped by a memory-bounded algorithm.
+  def write_report(self, url, counts, total):
+    n = self.settings['n']
+    self.z_obj.ex('DELETE FROM phrase_count WHERE zeomine_instance=? AND url=? AND n=?', (self.settings['run_id'], url, n))
+    if not counts:
+      return
+    max_phrase_count = max(counts.values())
+    limit = self.settings['report_limit']
+    # The fraction limits pass a phrase if its count is high enough. Find the
+    # lowest count that passes, checking each distinct count once.
+    min_count = 0
+    if limit['fraction'] or limit['normalized_fraction']:
+      passing = [c for c in set(counts.values()) if (not limit['fraction'] or c / total > limit['fraction']) and \
+        (not limit['normalized_fraction'] or c / max_phrase_count > limit['normalized_fraction'])]
+      if not passing:
+        return
+      min_count = min(passing)
+    if limit['max_phrases']:
+      phrases = [p for p in heapq.nlargest(limit['max_phrases'], counts, key=counts.get) if counts[p] >= min_count]
     else:
-      for substr in blacklist:
-        if substr in item:
-          return True
-      return False
-  
-  # Text Cleaner
-  def clean_text(self, text):
-    ret = []
-    #cleanup_list = [':', '-', '?', '&']
-    for t in text:
-      for c in self.settings['cleanup_list']:
-        t = t.replace(c, '')
-      if t:
-        if len(t) >= self.settings['min_length']:
-          if not self.in_blacklist(t, self.settings['blacklist']):
-            ret.append(t)
-    return ret
+      phrases = sorted([p for p in counts if counts[p] >= min_count], key=counts.get, reverse=True)
+    add = [(self.settings['run_id'], url, n, p, counts[p], counts[p] / total, counts[p] / max_phrase_count) for p in phrases]
+    self.z_obj.exm('insert into phrase_count values (?,?,?,?,?,?,?)', add)
 
   ##############################################################################
   # Zeomine plugins
@@ -95,73 +139,86 @@ class WordCount():
         # If not a dict, assume the section is a single property to set.
         else:
           self.settings[section] = conf[section]
-    self.z_obj.pprint('Successfully loaded WordCount.', 2, 2)
+    self.z_obj.pprint('Successfully loaded PhraseCount.', 2, 2)
 
   ## Initiate Plugin
   #
-  # 
+  #
   def initiate(self):
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS word_count (zeomine_instance int, url int, word text, count int, fraction float, normalized_fraction float)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS phrase_count (zeomine_instance text, url int, n int, phrase text, count int, fraction float, normalized_fraction float)',
+      'CREATE INDEX IF NOT EXISTS phrase_count_instance_url ON phrase_count (zeomine_instance, url, n)',
+    ])
+    self.z_obj.migrate('PhraseCount', migrations)
     if self.settings['run_id'] == 'current':
       self.settings['run_id'] = self.z_obj.run_id
     elif self.settings['run_id'] == 'previous':
-      self.settings['run_id'] = self.z_obj.run_id - 1
+      # Runs are recorded in the order they start
+      row = self.z_obj.fetchone('select uuid from zeomine_instances where rowid<(select rowid from zeomine_instances where uuid=?) order by rowid desc limit 1', (self.z_obj.run_id,))
+      if row:
+        self.settings['run_id'] = row[0]
+      else:
+        self.z_obj.pprint('PhraseCount: there is no previous run to report on.', 0)
+        self.settings['run_id'] = None
 
   ## Generate Reports and save data
   #
-  # 
+  # Text is read in URL order, so each URL's report is written as soon as its
+  # text is counted, and only one URL's counts are held at a time. The reports
+  # are rebuilt from all of the run's text, but only if there is text newer
+  # than the last report.
   def report(self):
+    key = self.watermark_key()
+    watermark = self.z_obj.get_watermark(key, self.settings['run_id'])
     if self.settings['selector']:
-      text_data = self.z_obj.fetchall('select url,extracted_text from text_extraction where zeomine_instance=? and selector=?', (self.settings['run_id'],self.settings['selector']))
+      where = 'zeomine_instance=? and selector=?'
+      args = (self.settings['run_id'], self.settings['selector'])
+    else:
+      where = 'zeomine_instance=?'
+      args = (self.settings['run_id'],)
+    last_rowid = self.z_obj.fetchone('select max(rowid) from text_extraction where ' + where, args)[0]
+    if not last_rowid or last_rowid <= watermark:
+      self.z_obj.pprint('PhraseCount: no new text since the last report.', 2)
+      return
+    # URL order comes from TextExtraction's url indexes. The unary + stops
+    # SQLite from using the rowid bound to pick the selector index instead.
+    if 'url' in self.settings['report_type']:
+      query = 'select url,extracted_text from text_extraction where ' + where + ' and +rowid<=? order by url,rowid'
     else:
-      text_data = self.z_obj.fetchall('select url,extracted_text from text_extraction where zeomine_instance=?', (self.settings['run_id'],))
-    # Calculate word counts
+      query = 'select url,extracted_text from text_extraction where ' + where + ' and rowid<=? order by rowid'
+    text_data = self.z_obj.iterquery(query, args + (last_rowid,))
+
+    # Count phrases
+    tokenizer = Tokenizer(self.settings['cleanup_list'], self.settings['blacklist'], self.settings['min_length'])
+    counting = self.settings['counting']
+    run = make_counter(counting['algorithm'], counting['capacity'], counting['width'], counting['depth'])
+    self.data['phrase_count'] = {'run': run, 'total': 0}
+    url = None
+    url_counts = Counter()
     for tdata in text_data:
-      td = tdata[1].strip("'").split(' ')
-      td = self.clean_text(td)
-      if 'url' in self.settings['report_type'] and tdata[0] not in self.data['word_count']['url']:
-        self.data['word_count']['url'][tdata[0]] = {}
-      for t in td:
-        tl = t.lower()
-        if 'run' in self.settings['report_type']:
-          if tl in self.data['word_count']['run']:
-            self.data['word_count']['run'][tl] += 1
-          else:
-            self.data['word_count']['run'][tl] = 1
-        if 'url' in self.settings['report_type']:
-          if tl in self.data['word_count']['url'][tdata[0]]:
-            self.data['word_count']['url'][tdata[0]][tl] += 1
-          else:
-            self.data['word_count']['url'][tdata[0]][tl] = 1
-
-    # Create reports
+      if tdata[0] != url and url is not None and 'url' in self.settings['report_type']:
+        self.write_report(url, url_counts, sum(url_counts.values()))
+        url_counts = Counter()
+      url = tdata[0]
+      phrases = self.phrases(tokenizer, tdata[1].strip("'"))
+      if 'run' in self.settings['report_type']:
+        run.update(phrases)
+        self.data['phrase_count']['total'] += len(phrases)
+      if 'url' in self.settings['report_type']:
+        url_counts.update(phrases)
+    if url is not None and 'url' in self.settings['report_type']:
+      self.write_report(url, url_counts, sum(url_counts.values()))
+
+    # Create the run report
     if 'run' in self.settings['report_type']:
-      max_word = max(self.data['word_count']['run'], key=self.data['word_count']['run'].get)
-      max_word_count = self.data['word_count']['run'][max_word]
-      total = sum(self.data['word_count']['run'].values())
-      
-      for word in sorted(self.data['word_count']['run'], key=self.data['word_count']['run'].get, reverse=True):
-        count = self.data['word_count']['run'][word]
-        frac = self.data['word_count']['run'][word] / total
-        norm = self.data['word_count']['run'][word] / max_word_count
-        self.z_obj.ex('insert into word_count values (?,0,?,?,?,?)', (self.settings['run_id'],word,count,frac,norm))
-      self.z_obj.com()
-    if 'url' in self.settings['report_type']:
-      for url in self.data['word_count']['url']:
-        max_word = max(self.data['word_count']['url'][url], key=self.data['word_count']['url'][url].get)
-        max_word_count = self.data['word_count']['url'][url][max_word]
-        total = sum(self.data['word_count']['url'][url].values())
-        
-        for word in sorted(self.data['word_count']['url'][url], key=self.data['word_count']['url'][url].get, reverse=True):
-          count = self.data['word_count']['url'][url][word]
-          frac = self.data['word_count']['url'][url][word] / total
-          norm = self.data['word_count']['url'][url][word] / max_word_count
-          self.z_obj.ex('insert into word_count values (?,?,?,?,?,?)', (self.settings['run_id'],url,word,count,frac,norm))
-        self.z_obj.com()
+      self.write_report(0, run.counts(), self.data['phrase_count']['total'])
+    self.z_obj.set_watermark(key, self.settings['run_id'], last_rowid)
+    self.z_obj.com()
 
   ## Final actions for Zeomine shutdown
   #
-  # 
+  #
   def shutdown(self):
     pass
 
@@ -171,6 +228,6 @@ class WordCount():
 
   ## Core Selenium Crawler callback
   #
-  # 
-  def core_crawler_selenium(self, current_url):
+  #
+  def core_crawler_selenium(self, current_url, current_url_id, browser = None):
     pass
@@ -30,15 +30,29 @@ class SeleniumElementProperties():
   # Helper Functions
   ##############################################################################
 
-  # Get the database id for an element, searching by hash. If the hash isn't found, add to DB
-  def get_element_id(self, hsh, string, urlid):
-    d = self.z_obj.fetchone('select rowid from selenium_element where item_hash=? and url=? and zeomine_instance=?', (hsh,urlid,self.z_obj.run_id))
-    if d:
-      return d[0]
-    else:
-      self.z_obj.ex('insert into selenium_element values (?,?,?,?)',(self.z_obj.run_id,urlid,hsh,string,))
-      self.data['cache'][hsh] = self.z_obj.cursor.lastrowid
-      return self.z_obj.cursor.lastrowid
+  # Get the database ids for a page's elements, searching by hash. Hashes that
+  # aren't found are added to the DB. One select finds the existing elements,
+  # one executemany adds the new ones, and one more select gets their ids.
+  def get_element_ids(self, elements, urlid):
+    rows = self.z_obj.fetchall('select item_hash,rowid from selenium_element where url=? and zeomine_instance=?', (urlid,self.z_obj.run_id))
+    ids = {}
+    for row in rows:
+      if row[0] not in ids:
+        ids[row[0]] = row[1]
+    add = []
+    for hsh in elements:
+      if hsh not in ids:
+        ids[hsh] = None
+        add.append((self.z_obj.run_id,urlid,hsh,elements[hsh],))
+    if add:
+      self.z_obj.exm('insert into selenium_element values (?,?,?,?)', add)
+      rows = self.z_obj.fetchall('select item_hash,rowid from selenium_element where url=? and zeomine_instance=?', (urlid,self.z_obj.run_id))
+      for row in rows:
+        if not ids.get(row[0]):
+          ids[row[0]] = row[1]
+    for hsh in elements:
+      self.data['cache'][hsh] = ids[hsh]
+    return ids
 
   ##############################################################################
   # Zeomine plugins
@@ -65,8 +79,16 @@ class SeleniumElementProperties():
   # 
   def initiate(self):
     # Create the data table if it doesn't exist yet
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS selenium_element (zeomine_instance text, url int, item_hash text, item_text text)')
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS selenium_element_data (zeomine_instance text, url int, item_id int, selector text, property_name text, property_value text)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS selenium_element (zeomine_instance text, url int, item_hash text, item_text text)',
+      'CREATE TABLE IF NOT EXISTS selenium_element_data (zeomine_instance text, url int, item_id int, selector text, property_name text, property_value text)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS selenium_element_instance_url_hash ON selenium_element (zeomine_instance, url, item_hash)',
+      'CREATE INDEX IF NOT EXISTS selenium_element_data_instance_url ON selenium_element_data (zeomine_instance, url)',
+    ])
+    self.z_obj.migrate('SeleniumElementProperties', migrations)
 
   ##############################################################################
   # Core Crawler - Selenium plugins
@@ -74,16 +96,23 @@ class SeleniumElementProperties():
 
   ## Core Selenium Crawler callback
   #
-  # 
-  def core_crawler_selenium(self, current_url, current_url_id):
+  # browser is the browser the page is open in, which is one of the crawler's
+  # browser pool. Without it, use the crawler's main browser.
+  def core_crawler_selenium(self, current_url, current_url_id, browser = None):
+    browser = browser or self.parent_obj.browser
+    # Read every element first, so the DB work can be done in bulk
+    found = []
+    elements = {}
     for selector in self.settings['selectors']:
-      i = self.parent_obj.browser.find_elements_by_css_selector(selector)
+      i = browser.find_elements_by_css_selector(selector)
       for item in i:
-        # Generate the hash and get the item ID first
+        # Generate the hash, and save the element's properties
         item_text = item.get_attribute('outerHTML')
         b = item_text.encode()
         h = hashlib.sha256(b).hexdigest()
-        item_id = self.get_element_id(h, item_text, current_url_id)
+        if h not in elements:
+          elements[h] = item_text
+        props = []
         for prop in self.settings['selectors'][selector]:
           if prop == 'size.height':
             prop_data = item.size['height']
@@ -97,6 +126,15 @@ class SeleniumElementProperties():
             prop_data = item.location['y']
           else:
             prop_data = item.get_attribute(prop)
-          add = (self.z_obj.run_id, current_url_id, item_id, selector, prop, prop_data)
-          self.z_obj.ex('insert into selenium_element_data values (?,?,?,?,?,?)', add)
+          props.append((prop, prop_data))
+        found.append((selector, h, props))
+    if not found:
+      return
+    # Get the item IDs, then queue up the properties
+    ids = self.get_element_ids(elements, current_url_id)
+    add = []
+    for selector, h, props in found:
+      for prop, prop_data in props:
+        add.append((self.z_obj.run_id, current_url_id, ids[h], selector, prop, prop_data))
+    self.z_obj.queuem('insert into selenium_element_data values (?,?,?,?,?,?)', add)
     self.z_obj.com()
@@ -1,5 +1,64 @@
+import hashlib
+import heapq
+import json
+import sqlite3
+from collections import Counter
+from functools import partial
+from core.utilities.zeomine_pool import pool_size, ordered_map
+from core.utilities.zeomine_tokenizer import Tokenizer
+
 ## Word Count
 #
+
+# Count the words in a URL's texts into the run Counter and the URL's Counter,
+# for the report types asked for. These are module functions so worker
+# processes can run them.
+def count_words(tokenizer, report_type, run, urls, url, texts):
+  counters = []
+  if 'run' in report_type:
+    counters.append(run)
+  if 'url' in report_type:
+    if url not in urls:
+      urls[url] = Counter()
+    counters.append(urls[url])
+  tokenizer.count(' '.join(texts), counters)
+
+# Count (rowid, url, extracted_text) rows, in rowid order. Consecutive rows for
+# a URL are counted together. Returns the last rowid, or None if there were no
+# rows.
+def count_rows(tokenizer, report_type, rows, run, urls):
+  last_rowid = None
+  url = None
+  texts = []
+  for tdata in rows:
+    last_rowid = tdata[0]
+    if tdata[1] != url and texts:
+      count_words(tokenizer, report_type, run, urls, url, texts)
+      texts = []
+    url = tdata[1]
+    texts.append(tdata[2].strip("'"))
+  if texts:
+    count_words(tokenizer, report_type, run, urls, url, texts)
+  return last_rowid
+
+# Worker process task: count the rows in a (low, high] rowid range, read with
+# the worker's own connection. Returns the run Counter and the URL Counters.
+def count_shard(conf, shard):
+  db = sqlite3.connect(conf['db_path'])
+  try:
+    query = 'select rowid,url,extracted_text from text_extraction where zeomine_instance=? and rowid>? and rowid<=?'
+    args = (conf['run_id'], shard[0], shard[1])
+    if conf['selector']:
+      query += ' and selector=?'
+      args += (conf['selector'],)
+    run = Counter()
+    urls = {}
+    tokenizer = Tokenizer(conf['cleanup_list'], conf['blacklist'], conf['min_length'])
+    count_rows(tokenizer, conf['report_type'], db.execute(query + ' order by rowid', args), run, urls)
+  finally:
+    db.close()
+  return run, urls
+
 class WordCount():
   ##############################################################################
   # Plugin Settings
@@ -39,6 +98,12 @@ class WordCount():
   settings['report_limit']['fraction'] = False
   settings['report_limit']['normalized_fraction'] = False
 
+  # Worker processes for counting in report. The new rows are split into
+  # rowid ranges, counted in parallel, and merged in order, so the reports
+  # are the same as counting them here. 0 counts them in this process. -1
+  # starts one per CPU. Databases in memory are always counted here.
+  settings['processes'] = 0
+
   # Local data dict
   data = {}
   data['word_count'] = {'run': {}, 'url': {}}
@@ -47,43 +112,82 @@ class WordCount():
   # Helper Functions
   ##############################################################################
 
+  # Count rows after the watermark in worker processes, and merge the counts
+  # in rowid order. Returns the last rowid counted.
+  def count_pool(self, watermark, processes):
+    # Workers read through their own connections, so they must see every row
+    self.z_obj.com(True)
+    query = 'select min(rowid),max(rowid) from text_extraction where zeomine_instance=? and rowid>?'
+    args = (self.settings['run_id'], watermark)
+    if self.settings['selector']:
+      query += ' and selector=?'
+      args += (self.settings['selector'],)
+    low, high = self.z_obj.fetchone(query, args)
+    if high is None:
+      return watermark
+    # Several shards per process, so one slow shard doesn't hold up the rest
+    shards = processes * 4
+    step = max(1, -(-(high - low + 1) // shards))
+    bounds = [(lo, min(lo + step, high)) for lo in range(low - 1, high, step)]
+    conf = {'db_path': self.z_obj.db_path, 'run_id': self.settings['run_id'], 'selector': self.settings['selector'],
+      'cleanup_list': self.settings['cleanup_list'], 'blacklist': self.settings['blacklist'], 'min_length': self.settings['min_length'],
+      'report_type': self.settings['report_type']}
+    for run, urls in ordered_map(partial(count_shard, conf), bounds, processes):
+      self.data['word_count']['run'].update(run)
+      for url in urls:
+        if url in self.data['word_count']['url']:
+          self.data['word_count']['url'][url].update(urls[url])
+        else:
+          self.data['word_count']['url'][url] = urls[url]
+    return high
+
   ###########
-  # Common data functions
+  # Incremental reports
 
-  # Check against whitelist: item contains a matching substring
-  def in_whitelist(self, item, whitelist):
-    if not whitelist:
-      return True
-    else:
-      for substr in whitelist:
-        substr = str(substr)
-        if substr in item:
-          return True
-      return False
-
-  # Check against blacklist: item does not contain a matching substring
-  def in_blacklist(self, item, blacklist):
-    if not blacklist:
-      return False
+  # Watermark key for this plugin. Totals only merge with counts made with the
+  # same settings, so changing them starts a new count.
+  def watermark_key(self):
+    conf = [self.settings['selector'], self.settings['blacklist'], self.settings['cleanup_list'], self.settings['min_length'], sorted(self.settings['report_type'])]
+    return 'WordCount:' + hashlib.md5(json.dumps(conf).encode()).hexdigest()
+
+  # Add new counts to the saved totals for a URL (0 for the whole run), and
+  # return the totals in the order words were first counted
+  def merge_totals(self, key, url, counts):
+    if counts:
+      add = [(self.settings['run_id'], key, url, word, counts[word]) for word in counts]
+      self.z_obj.exm('INSERT INTO word_count_totals VALUES (?,?,?,?,?) ON CONFLICT (zeomine_instance, config, url, word) DO UPDATE SET count=count+excluded.count', add)
+    rows = self.z_obj.fetchall('SELECT word,count FROM word_count_totals WHERE zeomine_instance=? AND config=? AND url=? ORDER BY rowid', (self.settings['run_id'], key, url))
+    return dict(rows)
+
+  # Replace the report for a URL (0 for the whole run) with one built from counts.
+  # The report has the most common words, most common first, that pass the
+  # fraction limits, up to max_words. Words are sorted only when there is no
+  # word limit. Otherwise a heap picks the top words.
+  def write_report(self, url, counts):
+    self.z_obj.ex('DELETE FROM word_count WHERE zeomine_instance=? AND url=?', (self.settings['run_id'], url))
+    if not counts:
+      return
+    max_word_count = max(counts.values())
+    total = sum(counts.values())
+    limit = self.settings['report_limit']
+    # The fraction limits pass a word if its count is high enough. Find the
+    # lowest count that passes, checking each distinct count once.
+    min_count = 0
+    if limit['fraction'] or limit['normalized_fraction']:
+      passing = [c for c in set(counts.values()) if (not limit['fraction'] or c / total > limit['fraction']) and \
+        (not limit['normalized_fraction'] or c / max_word_count > limit['normalized_fraction'])]
+      if not passing:
+        return
+      min_count = min(passing)
+    # nlargest gives the same order as a stable sort, ties in count order
+    if limit['max_words']:
+      words = [w for w in heapq.nlargest(limit['max_words'], counts, key=counts.get) if counts[w] >= min_count]
+    elif min_count:
+      words = sorted([w for w in counts if counts[w] >= min_count], key=counts.get, reverse=True)
     else:
-      for substr in blacklist:
-        substr = str(substr)
-        if substr in item:
-          return True
-      return False
-  
-  # Text Cleaner
-  def clean_text(self, text):
-    ret = []
-    #cleanup_list = [':', '-', '?', '&']
-    for t in text:
-      for c in self.settings['cleanup_list']:
-        t = t.replace(c, '')
-      if t:
-        if len(t) >= self.settings['min_length']:
-          if not self.in_blacklist(t.lower(), self.settings['blacklist']):
-            ret.append(t)
-    return ret
+      words = sorted(counts, key=counts.get, reverse=True)
+    add = [(self.settings['run_id'], url, word, counts[word], counts[word] / total, counts[word] / max_word_count) for word in words]
+    self.z_obj.exm('insert into word_count values (?,?,?,?,?,?)', add)
 
   ##############################################################################
   # Zeomine plugins
@@ -109,69 +213,55 @@ class WordCount():
   #
   # 
   def initiate(self):
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS word_count (zeomine_instance text, url int, word text, count int, fraction float, normalized_fraction float)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS word_count (zeomine_instance text, url int, word text, count int, fraction float, normalized_fraction float)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS word_count_instance_url ON word_count (zeomine_instance, url)',
+    ])
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS word_count_totals (zeomine_instance text, config text, url int, word text, count int)',
+      'CREATE UNIQUE INDEX IF NOT EXISTS word_count_totals_key ON word_count_totals (zeomine_instance, config, url, word)',
+    ])
+    self.z_obj.migrate('WordCount', migrations)
     if self.settings['run_id'] == 'current':
       self.settings['run_id'] = self.z_obj.run_id
 
   ## Generate Reports and save data
   #
-  # 
+  # Only text extracted since the last report for this run ID is counted. The
+  # new counts are merged into the totals in word_count_totals, and the reports
+  # they change are rebuilt, replacing the old ones.
   def report(self):
-    if self.settings['selector']:
-      text_data = self.z_obj.fetchall('select url,extracted_text from text_extraction where zeomine_instance=? and selector=?', (self.settings['run_id'],self.settings['selector']))
-    else:
-      text_data = self.z_obj.fetchall('select url,extracted_text from text_extraction where zeomine_instance=?', (self.settings['run_id'],))
+    key = self.watermark_key()
+    watermark = self.z_obj.get_watermark(key, self.settings['run_id'])
     # Calculate word counts
-    for tdata in text_data:
-      td = tdata[1].strip("'").split(' ')
-      td = self.clean_text(td)
-      if 'url' in self.settings['report_type'] and tdata[0] not in self.data['word_count']['url']:
-        self.data['word_count']['url'][tdata[0]] = {}
-      for t in td:
-        tl = t.lower()
-        if 'run' in self.settings['report_type']:
-          if tl in self.data['word_count']['run']:
-            self.data['word_count']['run'][tl] += 1
-          else:
-            self.data['word_count']['run'][tl] = 1
-        if 'url' in self.settings['report_type']:
-          if tl in self.data['word_count']['url'][tdata[0]]:
-            self.data['word_count']['url'][tdata[0]][tl] += 1
-          else:
-            self.data['word_count']['url'][tdata[0]][tl] = 1
-
-    # Create reports
+    self.data['word_count'] = {'run': Counter(), 'url': {}}
+    processes = pool_size(self.settings['processes'])
+    if processes > 1 and self.z_obj.db_path != ':memory:':
+      last_rowid = self.count_pool(watermark, processes)
+    else:
+      if self.settings['selector']:
+        text_data = self.z_obj.iterquery('select rowid,url,extracted_text from text_extraction where zeomine_instance=? and selector=? and rowid>? order by rowid', (self.settings['run_id'],self.settings['selector'],watermark))
+      else:
+        text_data = self.z_obj.iterquery('select rowid,url,extracted_text from text_extraction where zeomine_instance=? and rowid>? order by rowid', (self.settings['run_id'],watermark))
+      tokenizer = Tokenizer(self.settings['cleanup_list'], self.settings['blacklist'], self.settings['min_length'])
+      last_rowid = count_rows(tokenizer, self.settings['report_type'], text_data, self.data['word_count']['run'], self.data['word_count']['url'])
+      if last_rowid is None:
+        last_rowid = watermark
+    if last_rowid == watermark:
+      self.z_obj.pprint('WordCount: no new text since the last report.', 2)
+      return
+
+    # Merge into the totals, and create reports
     if 'run' in self.settings['report_type']:
-      max_word = max(self.data['word_count']['run'], key=self.data['word_count']['run'].get)
-      max_word_count = self.data['word_count']['run'][max_word]
-      total = sum(self.data['word_count']['run'].values())
-      i=0
-      for word in sorted(self.data['word_count']['run'], key=self.data['word_count']['run'].get, reverse=True):
-        if (not self.settings['report_limit']['max_words'] or i < self.settings['report_limit']['max_words']):
-          count = self.data['word_count']['run'][word]
-          frac = self.data['word_count']['run'][word] / total
-          norm = self.data['word_count']['run'][word] / max_word_count
-          if (not self.settings['report_limit']['fraction'] or frac > self.settings['report_limit']['fraction']) and \
-          (not self.settings['report_limit']['normalized_fraction'] or norm > self.settings['report_limit']['normalized_fraction']):
-            i += 1
-            self.z_obj.ex('insert into word_count values (?,0,?,?,?,?)', (self.settings['run_id'],word,count,frac,norm))
-      self.z_obj.com()
+      self.write_report(0, self.merge_totals(key, 0, self.data['word_count']['run']))
     if 'url' in self.settings['report_type']:
       for url in self.data['word_count']['url']:
-        max_word = max(self.data['word_count']['url'][url], key=self.data['word_count']['url'][url].get)
-        max_word_count = self.data['word_count']['url'][url][max_word]
-        total = sum(self.data['word_count']['url'][url].values())
-        i=0
-        for word in sorted(self.data['word_count']['url'][url], key=self.data['word_count']['url'][url].get, reverse=True):
-          if (not self.settings['report_limit']['max_words'] or i < self.settings['report_limit']['max_words']):
-            count = self.data['word_count']['url'][url][word]
-            frac = self.data['word_count']['url'][url][word] / total
-            norm = self.data['word_count']['url'][url][word] / max_word_count
-            if (not self.settings['report_limit']['fraction'] or frac > self.settings['report_limit']['fraction']) and \
-            (not self.settings['report_limit']['normalized_fraction'] or norm > self.settings['report_limit']['normalized_fraction']):
-              i += 1
-              self.z_obj.ex('insert into word_count values (?,?,?,?,?,?)', (self.settings['run_id'],url,word,count,frac,norm))
-        self.z_obj.com()
+        self.write_report(url, self.merge_totals(key, url, self.data['word_count']['url'][url]))
+    self.z_obj.set_watermark(key, self.settings['run_id'], last_rowid)
+    self.z_obj.com()
 
   ## Final actions for Zeomine shutdown
   #
@@ -186,5 +276,5 @@ class WordCount():
   ## Core Selenium Crawler callback
   #
   # 
-  def core_crawler_selenium(self, current_url):
+  def core_crawler_selenium(self, current_url, current_url_id, browser = None):
     pass
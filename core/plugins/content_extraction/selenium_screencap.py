@@ -65,13 +65,14 @@ class SeleniumScreencap():
         ok = False
     return ok
 
-  def take_screenshot(self, current_url, current_url_id, path, fname):
+  def take_screenshot(self, current_url, current_url_id, path, fname, browser = None):
+    browser = browser or self.parent_obj.browser
     if self.settings['file_type'] == 'png':
-      return self.parent_obj.browser.get_screenshot_as_png()
+      return browser.get_screenshot_as_png()
     elif  self.settings['file_type'] == 'pdf':
       fname_png = fname.replace(self.settings['file_type'], 'png')
       # TODO return a PDF
-      img = self.parent_obj.browser.get_screenshot_as_png()
+      img = browser.get_screenshot_as_png()
       with open(path + fname_png, 'wb') as f:
         f.write(img)
       if self.removeAlpha(path + fname_png):
@@ -104,7 +105,14 @@ class SeleniumScreencap():
   # 
   def initiate(self):
     # Create the data table if it doesn't exist yet
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS selenium_screencap (zeomine_instance text, url int, screencap_file text)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS selenium_screencap (zeomine_instance text, url int, screencap_file text)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS selenium_screencap_instance_url ON selenium_screencap (zeomine_instance, url)',
+    ])
+    self.z_obj.migrate('SeleniumScreencap', migrations)
     # TODO create directories if they do not exist
     self.z_obj.pprint('TODO add directory creation for SeleniumScreencap.', 0, 0)
 
@@ -114,11 +122,13 @@ class SeleniumScreencap():
 
   ## Core Selenium Crawler callback
   #
-  # 
-  def core_crawler_selenium(self, current_url, current_url_id):
+  # browser is the browser the page is open in, which is one of the crawler's
+  # browser pool. Without it, use the crawler's main browser.
+  def core_crawler_selenium(self, current_url, current_url_id, browser = None):
+    browser = browser or self.parent_obj.browser
     for s in self.settings['selectors']:
       #Screencap
-      items = self.parent_obj.browser.find_elements_by_css_selector(self.settings['selectors'][s])
+      items = browser.find_elements_by_css_selector(self.settings['selectors'][s])
       # We are expecting a single-item list
       for item in items:
         path = self.z_obj.settings['user_data']['base'] + self.z_obj.settings['user_data']['data'] + self.settings['image_path']
@@ -129,18 +139,19 @@ class SeleniumScreencap():
           h = round(item.size['height'])
           w = item.size['width']
           if self.settings['screen_width']:
-            self.parent_obj.browser.set_window_size(self.settings['screen_width'],h)
+            browser.set_window_size(self.settings['screen_width'],h)
           else:
-            self.parent_obj.browser.set_window_size(w,h)
+            browser.set_window_size(w,h)
           self.z_obj.pprint('start screencap', 2)
-          screencap = self.take_screenshot(current_url, current_url_id, path, fname)
+          screencap = self.take_screenshot(current_url, current_url_id, path, fname, browser)
           #~ item.screenshot(path + fname)
           self.z_obj.pprint(self.settings['file_type'] + ' captured', 2)
           with open(path + fname, 'wb') as f:
             f.write(screencap)
           self.z_obj.pprint('end screencap', 2)
           add = (self.z_obj.run_id, current_url_id, self.settings['image_path'] + fname)
-          self.z_obj.excom('insert into selenium_screencap values (?,?,?)', add)
+          # Written with the page, when the crawler commits after each URL
+          self.z_obj.queue('insert into selenium_screencap values (?,?,?)', add)
           self.z_obj.pprint('Screenshot: ' + self.settings['image_path'] + fname, 1)
         else:
           self.z_obj.pprint('Screenshot already taken.', 1)
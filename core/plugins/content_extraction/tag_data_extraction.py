@@ -1,9 +1,35 @@
+import hashlib
+import json
+from functools import partial
 from bs4 import BeautifulSoup
+from core.utilities.zeomine_pool import pool_size, ordered_map
 
 ## Tag Data Extraction
 #
 # Extracts data attributes from tags based on selector.
 
+# Extract tag data for each selector from a parse tree, as (selector, data) rows.
+# These are module functions so worker processes can run them.
+def extract_tag_data(parse, tags):
+  rows = []
+  for selector in tags:
+    search = parse.select(selector)
+    for item in search:
+      for dat in tags[selector]:
+        data = item.get(dat)
+        if data:
+          data_str = ''
+          if isinstance(data, str):
+            data_str = data
+          else:
+            data_str = ' '.join(data)
+          rows.append((selector, data_str))
+  return rows
+
+# Worker process task: parse a (url_id, crawl_data, text) document and extract from it
+def extract_tag_data_worker(tags, doc):
+  return (doc[0], doc[1], extract_tag_data(BeautifulSoup(doc[2], 'html.parser'), tags))
+
 class TagDataExtraction():
   ##############################################################################
   # Plugin Settings
@@ -12,6 +38,10 @@ class TagDataExtraction():
   # Define the parent ZSM object so we can call its functions and access its 
   # data. Set this in load_config
   z_obj = None
+
+  # Define the parent crawler object. This is set when the crawler runs this
+  # plugin as a document plugin, so pages are extracted during the crawl.
+  parent_obj = None
   
   # Settings dict
   settings = {}
@@ -27,6 +57,10 @@ class TagDataExtraction():
   # analysis on. Set to the UUID, or 'current' to get the current run.
   settings['run_id'] = 'current'
 
+  # Worker processes for parsing documents in evaluate_data. 0 parses them in
+  # this process. -1 starts one per CPU.
+  settings['processes'] = 0
+
   # Local data dict
   data = {}
 
@@ -34,27 +68,26 @@ class TagDataExtraction():
   # Helper Functions
   ##############################################################################
 
-  def get_text(self, url_id, doc):
-    parse = BeautifulSoup(doc, 'html.parser')
-    add = []
-    for selector in self.settings['tags']:
-      search = parse.select(selector)
-      for item in search:
-        for dat in self.settings['tags'][selector]:
-          data = item.get(dat)
-          if data:
-            data_str = ''
-            if isinstance(data, str):
-              data_str = data
-            else:
-              data_str = ' '.join(data)
-            add_info = (self.z_obj.run_id,)
-            add_info = add_info + (url_id,)
-            add_info = add_info + (selector,)
-            add_info = add_info + (data_str,)
-            add.append(add_info)
-    # Add all of the found items to the database
-    self.z_obj.exm('INSERT INTO tag_data_extraction VALUES (?,?,?,?)', add)
+  # Extract from a document. The parse tree comes from the shared document
+  # cache, so other plugins reading the same crawl_data don't parse it again.
+  def get_text(self, url_id, doc, crawl_data = None):
+    parse = self.z_obj.documents.get(crawl_data, doc)
+    add = [(self.settings['run_id'], url_id) + row for row in extract_tag_data(parse, self.settings['tags'])]
+    # Queue all of the found items for the database
+    self.z_obj.queuem('INSERT INTO tag_data_extraction VALUES (?,?,?,?)', add)
+
+  # Watermark key for this plugin. Changing what is extracted starts again from
+  # the first page of the run.
+  def watermark_key(self):
+    conf = [self.settings['tags']]
+    return 'TagDataExtraction:' + hashlib.md5(json.dumps(conf, sort_keys=True).encode()).hexdigest()
+
+  # Extract documents in worker processes. Rows come back in document order,
+  # and are written here in batches.
+  def get_text_pool(self, doclist, processes):
+    docs = ((doc_data[0], doc_data[2], doc_data[1]) for doc_data in doclist)
+    for url_id, crawl_data, rows in ordered_map(partial(extract_tag_data_worker, self.settings['tags']), docs, processes):
+      self.z_obj.queuem('INSERT INTO tag_data_extraction VALUES (?,?,?,?)', [(self.settings['run_id'], url_id) + row for row in rows])
 
   ##############################################################################
   # Zeomine plugins
@@ -81,7 +114,14 @@ class TagDataExtraction():
   # 
   def initiate(self):
     # Create the data table if it doesn't exist yet
-    self.z_obj.excom('CREATE TABLE IF NOT EXISTS tag_data_extraction (zeomine_instance text, url int, selector text, tag_data text)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS tag_data_extraction (zeomine_instance text, url int, selector text, tag_data text)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS tag_data_extraction_instance_selector ON tag_data_extraction (zeomine_instance, selector)',
+    ])
+    self.z_obj.migrate('TagDataExtraction', migrations)
     if self.settings['run_id'] == 'current':
       self.settings['run_id'] = self.z_obj.run_id
 
@@ -89,10 +129,35 @@ class TagDataExtraction():
   #
   # 
   def evaluate_data(self):
-    # Create the data table if it doesn't exist yet
-    doclist = self.z_obj.fetchall('select url,response_text,type from crawler_req_text inner join crawler_basic_data on crawler_req_text.crawl_data=crawler_basic_data.rowid where crawler_req_text.zeomine_instance=?',(str(self.z_obj.run_id),))
-    for doc_data in doclist:
-      if doc_data[2] == 'internal':
-        self.get_text(doc_data[0],doc_data[1])
+    # Only read documents saved since this plugin last ran on this run ID. Pages
+    # it already extracted during the crawl are behind the watermark.
+    watermark = self.z_obj.get_watermark(self.watermark_key(), self.settings['run_id'])
+    last = self.z_obj.fetchone('select max(crawl_data) from crawler_req_text where zeomine_instance=?', (str(self.settings['run_id']),))[0]
+    if not last or last <= watermark:
+      return
+    # Only internal pages are extracted, so only their bodies are read
+    doclist = self.z_obj.iterquery('select url,response_text,crawl_data from crawler_req_text inner join crawler_basic_data on crawler_req_text.crawl_data=crawler_basic_data.rowid where crawler_req_text.zeomine_instance=? and crawler_basic_data.type=? and crawler_req_text.crawl_data>? and crawler_req_text.crawl_data<=? order by crawler_req_text.crawl_data',(str(self.settings['run_id']),'internal',watermark,last))
+    processes = pool_size(self.settings['processes'])
+    if processes > 1:
+      self.get_text_pool(doclist, processes)
+    else:
+      for doc_data in doclist:
+        self.get_text(doc_data[0],doc_data[1],doc_data[2])
+    # One watermark for everything read, saved with the extracted rows
+    self.z_obj.set_watermark(self.watermark_key(), self.settings['run_id'], last)
     #Save the data aftter we are done extracting
     self.z_obj.com()
+
+  ##############################################################################
+  # Core Crawler plugins
+  ##############################################################################
+
+  ## Core Crawler document callback
+  #
+  # Called for each internal page as it is saved, when this plugin is in the
+  # crawler's 'document_plugins' setting.
+  def core_crawler_document(self, current_url, current_url_id, crawl_data, text):
+    # Pages from other runs are read in evaluate_data instead
+    if self.settings['run_id'] == self.z_obj.run_id:
+      self.get_text(current_url_id, text, crawl_data)
+      self.z_obj.set_watermark(self.watermark_key(), self.settings['run_id'], crawl_data)
@@ -1,6 +1,5 @@
 import importlib
 import json
-import requests
 import time
 
 ## Remote Configuration
@@ -98,7 +97,7 @@ class RemoteConf():
       
       # Get the config from the site if we didn't get any remote data
       if not remote_conf:
-        rc = requests.get(self.settings['conf_url'] + '?_format=json&api-key=' + self.settings['api_key'])
+        rc = self.z_obj.http_get(self.settings['conf_url'] + '?_format=json&api-key=' + self.settings['api_key'])
         if rc.status_code == 200:
           remote_conf = json.loads(rc.text)
         else:
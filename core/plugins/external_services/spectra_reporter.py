@@ -1,5 +1,4 @@
 import json
-import requests
 
 ## Spectra Reporter
 #
@@ -74,23 +73,16 @@ class SpectraReporter():
     return ret
 
   def prepare_data(self, query, data):
-    ret = []
     if 'plugin' in query:
       plugin = query['plugin']
       if plugin in self.plugins:
         if callable(getattr(self.plugins[plugin], 'prepare_spectra_data', False)):
           spectra_objects = self.plugins[plugin].prepare_spectra_data(query, data)
           if spectra_objects:
-            for so in spectra_objects:
-              ret.append(so)
-          else:
-            return []
-    else:
-      for d in data:
-        spectra_object = self.create_spectra_object(query['spectra'], d)
-        ret.append(spectra_object)
-      
-    return ret
+            return spectra_objects
+      return []
+    # Build each object as its row is read
+    return (self.create_spectra_object(query['spectra'], d) for d in data)
 
   def post_spectra_data(self):
     # Run through each query item
@@ -98,7 +90,10 @@ class SpectraReporter():
       # Do the query
       if '[current]' in query['query']:
         query['query'] = query['query'].replace('[current]', self.z_obj.run_id)
-      data = self.z_obj.fetchall(query['query'])
+      data = self.z_obj.iterquery(query['query'])
+      # Plugins get the whole result set at once
+      if 'plugin' in query:
+        data = list(data)
       spectra_objects = self.prepare_data(query, data)
       self.z_obj.pprint('Sending Spectra Objects',2)
       for so in spectra_objects:
@@ -106,7 +101,7 @@ class SpectraReporter():
         head = {'api-key': self.settings['server']['api_key']}
         head['Content-Type'] = 'application/json'
         spectraj = json.dumps(so)
-        req = requests.post(self.settings['server']['endpoint'], data=spectraj, headers=head)
+        req = self.z_obj.http_post(self.settings['server']['endpoint'], data=spectraj, headers=head)
         self.z_obj.pprint(req.status_code,2)
         self.z_obj.pprint(req.text,2)
 
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+from bs4 import BeautifulSoup
+
+## LRU Cache
+#
+# A dict with a maximum size. When it is full, the least recently used key is
+# dropped to make room. Used by Zeomine to intern URL and domain ids.
+class LRUCache():
+
+  # Init function
+  def __init__(self, capacity = 100000):
+    self.capacity = max(1, int(capacity))
+    self.items = OrderedDict()
+    self.lock = threading.Lock()
+
+  # Get a value, marking it as recently used
+  def get(self, key, default = None):
+    with self.lock:
+      if key in self.items:
+        self.items.move_to_end(key)
+        return self.items[key]
+      return default
+
+  # Set a value, dropping the least recently used if we are over capacity
+  def put(self, key, value):
+    with self.lock:
+      self.items[key] = value
+      self.items.move_to_end(key)
+      while len(self.items) > self.capacity:
+        self.items.popitem(last=False)
+
+  def __contains__(self, key):
+    return key in self.items
+
+  def __len__(self):
+    return len(self.items)
+
+## Document Cache
+#
+# Parsed BeautifulSoup trees, keyed by crawl_data id (the crawler_basic_data
+# rowid), so a page is parsed once and shared by the crawler and every
+# extraction plugin. Memory is bounded by the total length of the source HTML
+# kept; a tree takes several times that. The least recently used trees are
+# dropped first. Trees are shared, so callers must not modify them.
+class DocumentCache():
+
+  # Init function
+  def __init__(self, max_bytes = 5000000):
+    self.max_bytes = max(0, int(max_bytes))
+    self.size = 0
+    # crawl_data id: (tree, source length)
+    self.items = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  # Get the tree for a document. If it isn't cached, parse text and cache it.
+  # Without a crawl_data id, the text is parsed and not cached.
+  def get(self, crawl_data, text = None):
+    if crawl_data is not None:
+      with self.lock:
+        if crawl_data in self.items:
+          self.items.move_to_end(crawl_data)
+          self.hits += 1
+          return self.items[crawl_data][0]
+        self.misses += 1
+    if text is None:
+      return None
+    tree = BeautifulSoup(text, 'html.parser')
+    if crawl_data is not None:
+      self.put(crawl_data, tree, len(text))
+    return tree
+
+  # Add a tree that was already parsed, e.g. by the crawler
+  def put(self, crawl_data, tree, size):
+    with self.lock:
+      if crawl_data in self.items:
+        self.size -= self.items.pop(crawl_data)[1]
+      # Don't let one large page push out everything else
+      if size > self.max_bytes:
+        return
+      self.items[crawl_data] = (tree, size)
+      self.size += size
+      while self.size > self.max_bytes:
+        self.size -= self.items.popitem(last=False)[1][1]
+
+  def __contains__(self, crawl_data):
+    return crawl_data in self.items
+
+  def __len__(self):
+    return len(self.items)
@@ -0,0 +1,206 @@
+import random
+from collections import deque
+
+## Frontier Queue
+#
+# The list of URLs waiting to be crawled for one URL type, as used in
+# CoreCrawler.data['urls_to_crawl']. Items are dicts with at least a 'url' key.
+#
+# URLs are indexed in a dict, so membership checks, appends and pops are O(1)
+# no matter how long the queue gets, random pops included. Removed items are
+# dropped lazily when they reach the front of the queue. It supports the list
+# operations the crawler and plugins already use: append, pop(0), remove, len,
+# in and iteration.
+class FrontierQueue():
+
+  # Init function
+  def __init__(self, items = []):
+    # Crawl order. May hold stale entries for removed URLs.
+    self.queue = deque()
+    # Queued items, keyed by URL
+    self.items = {}
+    for item in items:
+      self.append(item)
+
+  # Get the URL from an item dict, or a plain URL string
+  def key(self, item):
+    if isinstance(item, dict):
+      return item['url']
+    return item
+
+  # Add an item to the end of the queue, unless its URL is already queued.
+  # Returns True if the item was added.
+  def append(self, item):
+    if item['url'] in self.items:
+      return False
+    self.items[item['url']] = item
+    self.queue.append(item)
+    return True
+
+  # Take an item off the front of the queue
+  def pop(self, index = 0):
+    if index != 0:
+      raise IndexError('FrontierQueue only supports pop(0)')
+    # Back to crawl order after random pops. Items keep their shuffled order.
+    if isinstance(self.queue, list):
+      self.queue = deque(self.queue)
+    while self.queue:
+      item = self.queue.popleft()
+      # Skip entries that were removed, or removed and queued again later
+      if self.items.get(item['url']) is item:
+        del self.items[item['url']]
+        return item
+    raise IndexError('pop from an empty FrontierQueue')
+
+  # Take a random item off the queue. Random pops keep the queue in a list, so
+  # the chosen entry can be swapped with the last one and popped in O(1).
+  def pop_random(self):
+    if not isinstance(self.queue, list):
+      self.queue = [i for i in self.queue if self.items.get(i['url']) is i]
+    while self.queue:
+      index = random.randrange(len(self.queue))
+      self.queue[index], self.queue[-1] = self.queue[-1], self.queue[index]
+      item = self.queue.pop()
+      if self.items.get(item['url']) is item:
+        del self.items[item['url']]
+        return item
+    raise IndexError('pop from an empty FrontierQueue')
+
+  # Remove a queued item, by item dict or URL
+  def remove(self, item):
+    url = self.key(item)
+    if url not in self.items:
+      raise ValueError('URL not in FrontierQueue: ' + str(url))
+    del self.items[url]
+    # Drop the stale entries once they make up most of the queue
+    if len(self.queue) > 2 * len(self.items) + 1000:
+      self.queue = type(self.queue)(i for i in self.queue if self.items.get(i['url']) is i)
+
+  # Look up the queued item for a URL
+  def get(self, url, default = None):
+    return self.items.get(url, default)
+
+  def __contains__(self, item):
+    return self.key(item) in self.items
+
+  def __len__(self):
+    return len(self.items)
+
+  # Iterate over a snapshot in crawl order, so items may be removed while looping
+  def __iter__(self):
+    return iter([i for i in self.queue if self.items.get(i['url']) is i])
+
+  # Mark a popped item as finished. Nothing to do for an in-memory queue.
+  def done(self, item):
+    pass
+
+## Persistent Frontier Queue
+#
+# A FrontierQueue backed by the crawler_frontier table, so the frontier is
+# saved as the crawl goes and a crashed or stopped crawl can pick up where it
+# left off. Only a window of the queue is held in memory. The rest is read
+# back from the database, in the order it was added, as the window empties.
+#
+# Rows are deleted when done() is called for a popped item, not when it is
+# popped, so URLs that were in flight when a crawl stopped are crawled again.
+class PersistentFrontierQueue(FrontierQueue):
+
+  # Init function. Any rows already saved for this URL type are resumed.
+  def __init__(self, z_obj, typ, window = 10000):
+    FrontierQueue.__init__(self)
+    self.z_obj = z_obj
+    self.typ = typ
+    self.window = max(1, int(window))
+    # Row ids for items in the window, and for popped items that are not done
+    self.rowids = {}
+    self.taken = {}
+    # Highest row id read into the window. Rows above this are only on disk.
+    self.last_rowid = 0
+    # Whether there are rows on disk that are not in the window
+    self.spilled = True
+    self.count = self.z_obj.fetchone('SELECT count(*) FROM crawler_frontier WHERE type=?', (typ,))[0]
+    self.refill()
+
+  # Read the next rows from the database into the window
+  def refill(self):
+    want = self.window - len(self.items)
+    rows = self.z_obj.fetchall('SELECT rowid,url,depth FROM crawler_frontier WHERE type=? AND rowid>? ORDER BY rowid LIMIT ?', (self.typ, self.last_rowid, want))
+    for row in rows:
+      item = {'url': row[1], 'depth': row[2]}
+      self.items[row[1]] = item
+      self.queue.append(item)
+      self.rowids[row[1]] = row[0]
+      self.last_rowid = row[0]
+    # A short read means everything on disk is now in the window
+    self.spilled = len(rows) >= want
+
+  # Add an item, saving it to the database. Returns True if the item was added.
+  def append(self, item):
+    if item['url'] in self.items:
+      return False
+    self.z_obj.ex('INSERT OR IGNORE INTO crawler_frontier VALUES (?,?,?)', (item['url'], self.typ, item['depth']))
+    if self.z_obj.cursor.rowcount < 1:
+      return False
+    self.count += 1
+    # Keep the item in memory only if everything before it is in the window
+    if not self.spilled and len(self.items) < self.window:
+      FrontierQueue.append(self, item)
+      self.rowids[item['url']] = self.z_obj.cursor.lastrowid
+      self.last_rowid = self.z_obj.cursor.lastrowid
+    else:
+      self.spilled = True
+    return True
+
+  def pop(self, index = 0):
+    if not self.items and self.spilled:
+      self.refill()
+    item = FrontierQueue.pop(self, index)
+    self.taken[item['url']] = self.rowids.pop(item['url'])
+    self.count -= 1
+    return item
+
+  # Random pops only choose from the window
+  def pop_random(self):
+    if not self.items and self.spilled:
+      self.refill()
+    item = FrontierQueue.pop_random(self)
+    self.taken[item['url']] = self.rowids.pop(item['url'])
+    self.count -= 1
+    return item
+
+  # Delete a popped item from the database once it has been crawled
+  def done(self, item):
+    rowid = self.taken.pop(self.key(item), None)
+    if rowid:
+      self.z_obj.ex('DELETE FROM crawler_frontier WHERE rowid=?', (rowid,))
+
+  def remove(self, item):
+    url = self.key(item)
+    if url in self.items:
+      FrontierQueue.remove(self, url)
+      self.z_obj.ex('DELETE FROM crawler_frontier WHERE rowid=?', (self.rowids.pop(url),))
+    else:
+      self.z_obj.ex('DELETE FROM crawler_frontier WHERE type=? AND url=?', (self.typ, url))
+      if self.z_obj.cursor.rowcount < 1:
+        raise ValueError('URL not in PersistentFrontierQueue: ' + str(url))
+    self.count -= 1
+
+  def get(self, url, default = None):
+    if url in self.items:
+      return self.items[url]
+    if self.spilled and url not in self.taken:
+      row = self.z_obj.fetchone('SELECT url,depth FROM crawler_frontier WHERE type=? AND url=?', (self.typ, url))
+      if row:
+        return {'url': row[0], 'depth': row[1]}
+    return default
+
+  def __contains__(self, item):
+    return self.get(self.key(item)) is not None
+
+  def __len__(self):
+    return self.count
+
+  # Iterate over a snapshot of the whole queue, including rows outside the window
+  def __iter__(self):
+    rows = self.z_obj.fetchall('SELECT url,depth FROM crawler_frontier WHERE type=? ORDER BY rowid', (self.typ,))
+    return iter([{'url': row[0], 'depth': row[1]} for row in rows if row[0] not in self.taken])
@@ -0,0 +1,51 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+## Zeomine HTTP client
+#
+# A single requests Session shared by the crawler and plugins through
+# Zeomine.http_get() and Zeomine.http_post(). Connections are pooled per host
+# and kept alive, so repeated requests to one domain reuse the same TCP/TLS
+# connection instead of opening a new one each time.
+class ZeomineHTTP():
+
+  # Defaults for settings['http'] in the Zeomine object
+  defaults = {}
+  # Number of hosts to keep connection pools for
+  defaults['pool_connections'] = 10
+  # Number of connections kept alive per host. Keep this at or above the
+  # crawler's worker count, or extra connections are discarded after use.
+  defaults['pool_maxsize'] = 10
+  # Seconds to wait for a connection, and for the server to send data
+  defaults['connect_timeout'] = 10
+  defaults['read_timeout'] = 30
+  # Retries for failed connections. Requests that reached the server are not retried.
+  defaults['max_retries'] = 0
+
+  # Init function
+  def __init__(self, settings = {}, user_agent = False):
+    self.settings = dict(self.defaults)
+    self.settings.update(settings)
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=self.settings['pool_connections'], pool_maxsize=self.settings['pool_maxsize'], max_retries=self.settings['max_retries'])
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    # The default headers already ask for gzip/deflate, plus br if brotli is
+    # installed. Responses are decompressed by requests.
+    if user_agent:
+      self.session.headers['User-Agent'] = user_agent
+
+  # Fill in the default timeout if none was given
+  def request(self, method, url, **kwargs):
+    if 'timeout' not in kwargs:
+      kwargs['timeout'] = (self.settings['connect_timeout'], self.settings['read_timeout'])
+    return self.session.request(method, url, **kwargs)
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def close(self):
+    self.session.close()
@@ -0,0 +1,96 @@
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup
+# lxml is optional. Without it, the 'lxml' extractor falls back to BeautifulSoup.
+try:
+  import lxml.html
+except ImportError:
+  lxml = None
+
+## Link extraction
+#
+# Reads link values out of a page for CoreCrawler.get_links. Selectors are the
+# same as settings['links']['selectors']: a dict with a tag name as key, and a
+# list of attributes to read as value, e.g. {'a': ['href']}.
+#
+# Every extractor returns the non-empty values in the same order: by selector,
+# then by element in document order, then by attribute. Available extractors:
+# - 'stream': the standard library HTML tokenizer. Reads start tags as they go
+#   by, and never builds a tree. This is the same tokenizer BeautifulSoup's
+#   'html.parser' uses, so the results match.
+# - 'lxml': lxml's C parser, if lxml is installed. Repairs broken markup its
+#   own way, so results can differ slightly on malformed pages.
+# - 'bs4': a full BeautifulSoup tree, as the crawler used to build.
+
+# Streaming tokenizer that collects the selected attributes of matching start tags
+class LinkParser(HTMLParser):
+
+  # Init function
+  def __init__(self, selectors):
+    HTMLParser.__init__(self)
+    self.selectors = selectors
+    self.found = {}
+    for selector in selectors:
+      self.found[selector] = []
+
+  def handle_starttag(self, tag, attrs):
+    if tag in self.selectors:
+      # Later duplicate attributes win, as in BeautifulSoup
+      attrs = dict(attrs)
+      for prop in self.selectors[tag]:
+        if attrs.get(prop):
+          self.found[tag].append(attrs[prop])
+
+def extract_stream(text, selectors):
+  parser = LinkParser(selectors)
+  parser.feed(text)
+  parser.close()
+  links = []
+  for selector in selectors:
+    links.extend(parser.found[selector])
+  return links
+
+def extract_lxml(text, selectors):
+  if not text or not text.strip():
+    return []
+  try:
+    root = lxml.html.document_fromstring(text)
+  except ValueError:
+    # lxml refuses strings that carry an XML encoding declaration
+    root = lxml.html.document_fromstring(text.encode('utf-8'))
+  links = []
+  for selector in selectors:
+    for item in root.iter(selector):
+      for prop in selectors[selector]:
+        u = item.get(prop)
+        if u:
+          links.append(u)
+  return links
+
+def extract_bs4(text, selectors):
+  return extract_tree(BeautifulSoup(text, 'html.parser'), selectors)
+
+# Extract links from a BeautifulSoup tree that was already parsed
+def extract_tree(parse, selectors):
+  links = []
+  for selector in selectors:
+    for item in parse.find_all(selector):
+      for prop in selectors[selector]:
+        u = item.get(prop)
+        if u:
+          links.append(u)
+  return links
+
+extractors = {'stream': extract_stream, 'lxml': extract_lxml, 'bs4': extract_bs4}
+
+# Extract links with the named extractor. Falls back to BeautifulSoup if the
+# extractor is unknown or unavailable, or fails on the page.
+def extract_links(text, selectors, extractor = 'stream'):
+  if extractor == 'lxml' and lxml is None:
+    extractor = 'bs4'
+  func = extractors.get(extractor, extract_bs4)
+  if func is extract_bs4:
+    return extract_bs4(text, selectors)
+  try:
+    return func(text, selectors)
+  except Exception:
+    return extract_bs4(text, selectors)
@@ -0,0 +1,32 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+## Process pool
+#
+# Runs CPU-bound work, like parsing HTML, across several cores. Used by the
+# extraction plugins' 'processes' setting. The function and items must be
+# picklable, so use module-level functions rather than plugin methods.
+
+# Number of worker processes for a 'processes' setting. -1 means one per CPU.
+def pool_size(processes):
+  if not processes:
+    return 0
+  processes = int(processes)
+  if processes < 0:
+    return os.cpu_count() or 1
+  return processes
+
+# Map func over items in worker processes, yielding results in the same order
+# as items. Only a window of items is in flight at a time, so items can be
+# streamed from the database without reading them all into memory.
+def ordered_map(func, items, processes, window = 0):
+  window = window or processes * 4
+  with ProcessPoolExecutor(max_workers = processes) as pool:
+    pending = deque()
+    for item in items:
+      pending.append(pool.submit(func, item))
+      if len(pending) >= window:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
@@ -0,0 +1,79 @@
+import hashlib
+import math
+from array import array
+from bisect import bisect_left
+
+## Bloom Filter
+#
+# A fixed-size set that can answer "definitely not added" or "probably added".
+# Sized for an expected number of items and a false positive rate.
+class BloomFilter():
+
+  # Init function
+  def __init__(self, capacity = 1000000, error_rate = 0.01):
+    capacity = max(1, int(capacity))
+    self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+    self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+    self.bits = bytearray(self.size // 8 + 1)
+
+  # Bit positions for an item, by double hashing one 128 bit digest
+  def positions(self, item):
+    d = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+    h1 = int.from_bytes(d[:8], 'little')
+    h2 = int.from_bytes(d[8:], 'little') | 1
+    return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+  def add(self, item):
+    for p in self.positions(item):
+      self.bits[p >> 3] |= 1 << (p & 7)
+
+  def __contains__(self, item):
+    for p in self.positions(item):
+      if not self.bits[p >> 3] & (1 << (p & 7)):
+        return False
+    return True
+
+## Seen Set
+#
+# The set of URL ids that have already been crawled. A Bloom filter answers
+# most lookups for new URLs. Anything it lets through is checked exactly
+# against a sorted array of ids from past runs, and a set of ids crawled in
+# this run. No lookups go to the database.
+class SeenSet():
+
+  # Init function
+  def __init__(self, capacity = 1000000, error_rate = 0.01):
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.bloom = BloomFilter(capacity, error_rate)
+    # Sorted ids from past runs, 8 bytes each
+    self.history = array('q')
+    # Ids added during this run
+    self.added = set()
+
+  # Load the ids crawled in past runs. The filter is resized to fit them.
+  def load(self, ids):
+    self.history = array('q', sorted(ids))
+    self.bloom = BloomFilter(max(self.capacity, 2 * len(self.history)), self.error_rate)
+    for i in self.history:
+      self.bloom.add(i)
+    for i in self.added:
+      self.bloom.add(i)
+
+  def add(self, item):
+    if item not in self.added:
+      self.added.add(item)
+      self.bloom.add(item)
+
+  # Take back an id added during this run, e.g. a page that failed to save.
+  # Its filter bits stay set, so lookups for it fall through to the exact check.
+  def discard(self, item):
+    self.added.discard(item)
+
+  def __contains__(self, item):
+    if item not in self.bloom:
+      return False
+    if item in self.added:
+      return True
+    i = bisect_left(self.history, item)
+    return i < len(self.history) and self.history[i] == item
@@ -0,0 +1,127 @@
+import heapq
+import random
+from array import array
+from collections import Counter
+
+## Frequency sketches
+#
+# Counters for finding the most common items in a stream, like PhraseCount's
+# n-grams. Each one has update(items), which counts every item in an iterable
+# once, and counts(), which returns a dict of item: count for the items it
+# kept. Available algorithms:
+# - 'exact': a plain Counter. Exact, but memory grows with every distinct item.
+# - 'space_saving': the Space-Saving algorithm. Keeps at most capacity items.
+#   When a new item arrives and it is full, the least counted item is replaced,
+#   and the new item takes over its count. Counts can be too high by at most
+#   the replaced count, and any item seen more than total / capacity times is
+#   always kept.
+# - 'count_min': a count-min sketch of width x depth counters, plus the
+#   capacity items with the highest estimates. Estimates can only be too high,
+#   by at most about 2 / width of the total with high probability.
+
+# Exact counts
+class ExactCount(Counter):
+
+  def counts(self):
+    return self
+
+# Space-Saving counts
+class SpaceSaving():
+
+  # Init function
+  def __init__(self, capacity = 100000):
+    self.capacity = max(1, int(capacity))
+    self.count = {}
+    # Min-heap of (count, item), one entry per item. Entries go stale as
+    # counts grow, and are fixed up when they reach the top.
+    self.heap = []
+
+  # Pop the item with the lowest count, and return its count
+  def pop_min(self):
+    while True:
+      c, item = heapq.heappop(self.heap)
+      if self.count[item] == c:
+        del self.count[item]
+        return c
+      heapq.heappush(self.heap, (self.count[item], item))
+
+  def update(self, items):
+    count = self.count
+    for item in items:
+      if item in count:
+        count[item] += 1
+      elif len(count) < self.capacity:
+        count[item] = 1
+        heapq.heappush(self.heap, (1, item))
+      else:
+        c = self.pop_min()
+        count[item] = c + 1
+        heapq.heappush(self.heap, (c + 1, item))
+
+  def counts(self):
+    return self.count
+
+# Count-min sketch, tracking the items with the highest estimates
+class CountMinTopK():
+
+  # Mersenne prime for the row hash functions
+  prime = 2 ** 61 - 1
+
+  # Init function
+  def __init__(self, capacity = 100000, width = 200000, depth = 4):
+    self.capacity = max(1, int(capacity))
+    self.width = max(1, int(width))
+    self.table = [array('q', bytes(8 * self.width)) for i in range(max(1, int(depth)))]
+    # Each row has its own hash function, (a * hash(item) + b) mod a prime.
+    # Salting hash() itself doesn't work: tuple hashes that collide in one
+    # row tend to collide in all of them.
+    rand = random.Random(0)
+    self.hashes = [(rand.randrange(1, self.prime), rand.randrange(self.prime)) for row in self.table]
+    self.top = {}
+    # Min-heap of (estimate, item) for the tracked items, with stale entries
+    # as in SpaceSaving
+    self.heap = []
+
+  # Add to an item's counters, and return its new estimate
+  def add(self, item, count = 1):
+    h = hash(item)
+    est = None
+    for (a, b), row in zip(self.hashes, self.table):
+      i = (a * h + b) % self.prime % self.width
+      row[i] += count
+      if est is None or row[i] < est:
+        est = row[i]
+    return est
+
+  # Lowest estimate among the tracked items
+  def min_top(self):
+    while True:
+      est, item = self.heap[0]
+      if self.top.get(item) == est:
+        return est
+      heapq.heapreplace(self.heap, (self.top[item], item))
+
+  def update(self, items):
+    top = self.top
+    for item in items:
+      est = self.add(item)
+      if item in top:
+        top[item] = est
+      elif len(top) < self.capacity:
+        top[item] = est
+        heapq.heappush(self.heap, (est, item))
+      elif est > self.min_top():
+        del top[heapq.heappop(self.heap)[1]]
+        top[item] = est
+        heapq.heappush(self.heap, (est, item))
+
+  def counts(self):
+    return self.top
+
+# Make a counter for an algorithm name. Unknown names count exactly.
+def make_counter(algorithm = 'exact', capacity = 100000, width = 200000, depth = 4):
+  if algorithm == 'space_saving':
+    return SpaceSaving(capacity)
+  if algorithm == 'count_min':
+    return CountMinTopK(capacity, width, depth)
+  return ExactCount()
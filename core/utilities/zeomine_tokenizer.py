@@ -0,0 +1,107 @@
+## Tokenizer
+#
+# Splits extracted text into the words WordCount counts, and counts them. The
+# results are the same as cleaning each space-separated token with every
+# cleanup_list entry in turn, dropping empty, short and blacklisted tokens,
+# and counting the rest lowercased. But the work is done on the whole text at
+# once with string and set methods, instead of token by token:
+# - Cleanup runs on the UTF-8 bytes. Runs of single-character ASCII entries
+#   are removed in one bytes.translate pass. Other entries are removed with
+#   bytes.replace, in their place in the list. UTF-8 never matches part of a
+#   character, so this removes exactly what str.replace would.
+# - The text is lowercased at once. Spaces end a word for lowercasing rules.
+# - Each distinct word is checked against min_length and the blacklist once.
+#   Blacklist entries still match as substrings of the lowercased word.
+# - Counting is done with Counter.update on the token list.
+class Tokenizer():
+
+  # Distinct words to remember checking before starting over
+  memo_size = 1000000
+
+  # Init function
+  def __init__(self, cleanup_list = [], blacklist = [], min_length = 1):
+    self.min_length = min_length or 0
+    # Cleanup steps in order, as UTF-8: ('delete', bytes of single-character
+    # entries) or ('replace', an entry to remove). Deleting single characters
+    # can't create or break another single-character match, so within a run
+    # of them the order doesn't matter.
+    self.steps = []
+    chars = b''
+    others = []
+    for c in cleanup_list:
+      if len(c) == 1:
+        if ord(c) < 128:
+          chars += c.encode()
+        else:
+          others.append(('replace', c.encode('utf-8')))
+      elif c:
+        if chars:
+          self.steps.append(('delete', chars))
+          chars = b''
+        self.steps.extend(others)
+        others = []
+        self.steps.append(('replace', c.encode('utf-8')))
+    if chars:
+      self.steps.append(('delete', chars))
+    self.steps.extend(others)
+    # An entry with a space in it could match across two tokens, so then we
+    # have to clean each token on its own
+    self.whole_text = not any(' ' in c for c in cleanup_list)
+    self.blacklist = [str(b) for b in blacklist]
+    # Words checked so far, and the ones to skip
+    self.checked = set()
+    self.skipped = set()
+
+  # Apply the cleanup steps to a string
+  def clean(self, text):
+    if not self.steps:
+      return text
+    b = text.encode('utf-8', 'surrogatepass')
+    for step in self.steps:
+      if step[0] == 'delete':
+        b = b.translate(None, step[1])
+      else:
+        b = b.replace(step[1], b'')
+    return b.decode('utf-8', 'surrogatepass')
+
+  # Get the lowercase words to count from a text, in order. May include empty
+  # strings, which are not counted.
+  def words(self, text):
+    if self.whole_text:
+      text = self.clean(text)
+    else:
+      text = ' '.join([self.clean(t) for t in text.split(' ')])
+    # Lowercasing makes U+0130 two characters long, and min_length counts the
+    # token as found, so drop short tokens before lowercasing if it is there
+    if self.min_length > 1 and 'İ' in text:
+      text = ' '.join([t if len(t) >= self.min_length else '' for t in text.split(' ')])
+    words = text.lower().split(' ')
+    if self.blacklist or self.min_length > 1:
+      if len(self.checked) > self.memo_size:
+        self.checked.clear()
+        self.skipped.clear()
+      new = set(words)
+      new.difference_update(self.checked)
+      for w in new:
+        self.checked.add(w)
+        if self.skip(w):
+          self.skipped.add(w)
+      if not self.skipped.isdisjoint(words):
+        words = [w for w in words if w not in self.skipped]
+    return words
+
+  # Whether to skip a lowercased word: too short, or blacklisted
+  def skip(self, w):
+    if len(w) < self.min_length:
+      return True
+    for substr in self.blacklist:
+      if substr in w:
+        return True
+    return False
+
+  # Count the words in a text into each of the given Counters
+  def count(self, text, counters):
+    words = self.words(text)
+    for counter in counters:
+      counter.update(words)
+      counter.pop('', None)
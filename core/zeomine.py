@@ -1,8 +1,10 @@
 import importlib
 import json
 import os
+import re
 import sqlite3
 import sys
+import threading
 import time
 import uuid
 import yaml
@@ -10,7 +12,9 @@ from collections import OrderedDict
 from datetime import datetime
 from os import mkdir
 
+from core.utilities.zeomine_cache import LRUCache, DocumentCache
 from core.utilities.zeomine_common import TimeoutException
+from core.utilities.zeomine_http import ZeomineHTTP
 
 # Zeomine Python class
 class Zeomine():
@@ -42,6 +46,49 @@ class Zeomine():
   # DB File path, relative to user data directory
   settings['db_path'] = 'zeomine_data.db'
 
+  # Database write settings
+  settings['db'] = {}
+  # SQLite journal mode and synchronous level. Set either to False to keep
+  # SQLite's default. With synchronous None, it follows durability: FULL for
+  # 'strict', and NORMAL for 'batch'. WAL with NORMAL only syncs to disk at
+  # checkpoints, so a power loss can lose the last commits.
+  settings['db']['journal_mode'] = 'WAL'
+  settings['db']['synchronous'] = None
+  # 'strict': every com() call commits, as components expect.
+  # 'batch': com() only commits once batch_size writes are waiting, or
+  # batch_time seconds have passed since the last commit. A crash can lose
+  # the writes since the last commit, but each commit is still atomic.
+  settings['db']['durability'] = 'strict'
+  # Rows held by queue() before they are written, and the commit thresholds
+  # for 'batch' durability
+  settings['db']['batch_size'] = 1000
+  settings['db']['batch_time'] = 2
+  # Rows read at a time by iterquery()
+  settings['db']['iter_batch_size'] = 100
+
+  # Shared HTTP client: connection pool sizes, timeouts and retries.
+  # See ZeomineHTTP.defaults for the available keys.
+  settings['http'] = {}
+
+  # URL and domain id cache shared by the crawlers: the number of ids to keep
+  # for each, and whether to load the most recent ones from the DB on startup.
+  settings['id_cache'] = {}
+  settings['id_cache']['urls'] = 100000
+  settings['id_cache']['domains'] = 10000
+  settings['id_cache']['preload'] = True
+
+  # Parsed document cache shared by the crawler and plugins. Bounded by the
+  # total length of the cached pages' HTML, in characters. 0 turns it off.
+  # Trees take several times their HTML, so this only needs to hold the pages
+  # being worked on.
+  settings['document_cache'] = {}
+  settings['document_cache']['max_bytes'] = 5000000
+
+  # Keep the DB and cache defaults, as a config file replaces whole settings dicts
+  db_defaults = dict(settings['db'])
+  id_cache_defaults = dict(settings['id_cache'])
+  document_cache_defaults = dict(settings['document_cache'])
+
   # Config dict
   conf = {}
   conf['crawler'] = {}
@@ -53,9 +100,32 @@ class Zeomine():
   data['metadata'] = {}
   data['plugins'] = {}
 
-  # Database
+  # Database. The connection may be shared with crawler threads: statements are
+  # serialized with db_lock, and each thread gets its own cursor (see cursor()).
   db = None
+  db_lock = threading.RLock()
+  db_local = threading.local()
+  # Path the database was opened from, ':memory:' if it has no file. Worker
+  # processes use this to open their own connections.
+  db_path = ':memory:'
+
+  # Write-behind queue: rows waiting to be inserted, grouped by statement, the
+  # tables they go to, and the number of writes since the last commit
+  pending = OrderedDict()
+  pending_count = 0
+  pending_tables = {}
+  uncommitted = 0
+  last_commit = 0
+
+  # Shared HTTP client. Use http_get() and http_post() rather than this directly.
+  http = None
   
+  # Id caches for 'urls' and 'domains', keyed by URL or domain string. Set up in initiate().
+  id_cache = {}
+
+  # Parsed documents, keyed by crawl_data id. Set up in initiate().
+  documents = None
+
   # Run ID: Get this when we start up the database
   run_id = 0
 
@@ -140,43 +210,133 @@ class Zeomine():
   ####################
   ## DB Commands
 
+  # The calling thread's cursor, so lastrowid and rowcount after ex() always
+  # belong to that thread's own statement
+  @property
+  def cursor(self):
+    c = getattr(self.db_local, 'cursor', None)
+    if c is None or getattr(self.db_local, 'db', None) is not self.db:
+      c = self.db.cursor()
+      self.db_local.cursor = c
+      self.db_local.db = self.db
+    return c
+
+  # Write the queued rows if a read touches a table they go to, so reads see
+  # them. Reads of other tables, like the id lookups, leave the queue alone.
+  def flush_for(self, command):
+    if self.pending_count:
+      for table in self.pending_tables.values():
+        if table is None or table.search(command):
+          self.flush()
+          return
+
   # Fetch one item from a select statement
   def fetchone(self, command, data = False):
-    if data:
-      r = self.cursor.execute(command, data)
-      ret = r.fetchone()
-    else:
-      r = self.cursor.execute(command)
-      ret = r.fetchone()
+    with self.db_lock:
+      self.flush_for(command)
+      if data:
+        r = self.cursor.execute(command, data)
+        ret = r.fetchone()
+      else:
+        r = self.cursor.execute(command)
+        ret = r.fetchone()
     return ret
 
   # Fetch all items from a select statment
   def fetchall(self, command, data = False):
-    if data:
-      r = self.cursor.execute(command, data)
-      ret = r.fetchall()
-    else:
-      r = self.cursor.execute(command)
-      ret = r.fetchall()
+    with self.db_lock:
+      self.flush_for(command)
+      if data:
+        r = self.cursor.execute(command, data)
+        ret = r.fetchall()
+      else:
+        r = self.cursor.execute(command)
+        ret = r.fetchall()
     return ret
 
+  # Iterate over the results of a select statement, reading batch_size rows at
+  # a time, so large result sets are never all in memory. The query gets its
+  # own cursor, so other DB commands can run while iterating. The DB lock is
+  # only held while reading each batch.
+  def iterquery(self, command, data = False, batch_size = None):
+    if not batch_size:
+      batch_size = self.settings['db']['iter_batch_size']
+    with self.db_lock:
+      self.flush_for(command)
+      c = self.db.cursor()
+      if data:
+        c.execute(command, data)
+      else:
+        c.execute(command)
+    try:
+      while True:
+        with self.db_lock:
+          rows = c.fetchmany(batch_size)
+        if not rows:
+          break
+        for row in rows:
+          yield row
+    finally:
+      c.close()
+
   # Execute a DB command
   def ex(self, command, data = False):
-    if data:
-      self.cursor.execute(command, data)
-    else:
-      self.cursor.execute(command)
+    with self.db_lock:
+      self.uncommitted += 1
+      if data:
+        self.cursor.execute(command, data)
+      else:
+        self.cursor.execute(command)
 
   # Execute many DB commands
   def exm(self, command, data = False):
     if data:
-      self.cursor.executemany(command, data)
+      with self.db_lock:
+        self.uncommitted += 1
+        self.cursor.executemany(command, data)
     else:
       self.pprint('Non-fatal error: Attemtped to run Zeomine.exm() without data')
 
-  # Commit DB data
-  def com(self):
-    self.db.commit()
+  # Queue a row to be written later with executemany, along with other rows for
+  # the same statement. Use this for inserts where nothing needs the new rowid.
+  def queue(self, command, data):
+    with self.db_lock:
+      if command not in self.pending:
+        self.pending[command] = []
+        # None if the table can't be found, so every read flushes
+        table = re.match(r'\s*insert\s+(?:or\s+\w+\s+)?into\s+(\w+)', command, re.I)
+        self.pending_tables[command] = re.compile(r'\b' + table.group(1) + r'\b', re.I) if table else None
+      self.pending[command].append(data)
+      self.pending_count += 1
+      if self.pending_count >= self.settings['db']['batch_size']:
+        self.flush()
+
+  # Queue many rows for the same statement
+  def queuem(self, command, data):
+    for d in data:
+      self.queue(command, d)
+
+  # Write all queued rows. This does not commit them.
+  def flush(self):
+    with self.db_lock:
+      pending = self.pending
+      self.pending = OrderedDict()
+      self.pending_count = 0
+      self.pending_tables = {}
+      for command in pending:
+        self.exm(command, pending[command])
+
+  # Commit DB data. With 'batch' durability this only commits when a batch
+  # threshold is reached. Use force to commit right away.
+  def com(self, force = False):
+    with self.db_lock:
+      if force or self.settings['db']['durability'] != 'batch' \
+      or self.uncommitted + self.pending_count >= self.settings['db']['batch_size'] \
+      or time.time() - self.last_commit >= self.settings['db']['batch_time']:
+        self.flush()
+        self.db.commit()
+        self.uncommitted = 0
+        self.last_commit = time.time()
 
   # Execute a DB command, and then commit it
   def excom(self, command, data = False):
@@ -188,6 +348,79 @@ class Zeomine():
     self.exm(command, data)
     self.com()
 
+  ####################
+  ## Schema migrations
+
+  # Bring a component's tables up to date. 'migrations' is a list of steps,
+  # each a list of SQL statements. A step's version is its position in the list,
+  # starting at 1. Applied versions are recorded in zeomine_schema, so each
+  # step runs once and existing databases are upgraded in place on startup.
+  # Only ever add new steps to the end of the list.
+  def migrate(self, component, migrations):
+    row = self.fetchone('SELECT version FROM zeomine_schema WHERE component=?', (component,))
+    version = row[0] if row else 0
+    for v in range(version, len(migrations)):
+      self.pprint('Applying ' + component + ' schema version ' + str(v + 1), 2, 2)
+      for statement in migrations[v]:
+        self.ex(statement)
+      if row:
+        self.ex('UPDATE zeomine_schema SET version=? WHERE component=?', (v + 1, component))
+      else:
+        self.ex('INSERT INTO zeomine_schema VALUES (?,?)', (component, v + 1))
+        row = (v + 1,)
+    self.com()
+
+  ####################
+  ## Plugin watermarks
+
+  # The last source rowid a plugin processed for a run, so evaluation can pick
+  # up where it left off. 'plugin' is any key the plugin chooses, usually its
+  # class name. Returns 0 if the plugin has not processed anything yet.
+  def get_watermark(self, plugin, run_id):
+    row = self.fetchone('SELECT last_rowid FROM plugin_watermarks WHERE plugin=? AND zeomine_instance=?', (plugin, run_id))
+    return row[0] if row else 0
+
+  # Record the last source rowid processed. Set this along with the plugin's
+  # own rows, so both are committed together.
+  def set_watermark(self, plugin, run_id, last_rowid):
+    self.ex('INSERT OR REPLACE INTO plugin_watermarks VALUES (?,?,?)', (plugin, run_id, last_rowid))
+
+  ####################
+  ## URL/domain id cache
+
+  # Create the id caches, and warm them with the most recent ids in one query each
+  def load_id_cache(self):
+    for key in self.id_cache_defaults:
+      if key not in self.settings['id_cache']:
+        self.settings['id_cache'][key] = self.id_cache_defaults[key]
+    self.id_cache = {}
+    self.id_cache['urls'] = LRUCache(self.settings['id_cache']['urls'])
+    self.id_cache['domains'] = LRUCache(self.settings['id_cache']['domains'])
+    if self.settings['id_cache']['preload']:
+      for table, column in [('urls', 'url'), ('domains', 'domain')]:
+        rows = self.fetchall('SELECT ' + column + ',rowid FROM ' + table + ' ORDER BY rowid DESC LIMIT ?', (self.id_cache[table].capacity,))
+        # Add the oldest first, so the newest are the last to be dropped
+        for row in reversed(rows):
+          self.id_cache[table].put(row[0], row[1])
+
+  ####################
+  ## HTTP Commands
+
+  # Get the shared HTTP client, creating it on first use. This is lazy since
+  # RemoteConf makes requests before the database is initiated.
+  def http_client(self):
+    if not self.http:
+      self.http = ZeomineHTTP(self.settings['http'], self.settings['user_agent'])
+    return self.http
+
+  # Make a GET request through the shared HTTP client
+  def http_get(self, url, **kwargs):
+    return self.http_client().get(url, **kwargs)
+
+  # Make a POST request through the shared HTTP client
+  def http_post(self, url, **kwargs):
+    return self.http_client().post(url, **kwargs)
+
   ##############################################################################
   # Core functions
   ##############################################################################
@@ -313,13 +546,51 @@ class Zeomine():
     db_path = ':memory:'
     if self.settings['db_path']:
       db_path = self.settings['user_data']['base'] + self.settings['user_data']['data'] + self.settings['db_path']
-    self.db = sqlite3.connect(db_path)
-    self.cursor = self.db.cursor()
-
-    # Create the basic data tables if they don't exist
-    self.excom('CREATE TABLE IF NOT EXISTS zeomine_instances (uuid text, description text, time_format text, time real)')
-    self.excom('CREATE TABLE IF NOT EXISTS domains (domain text, https int, subdomain_of int)')
-    self.excom('CREATE TABLE IF NOT EXISTS urls (url text, domain int)')
+    self.db = sqlite3.connect(db_path, check_same_thread=False)
+    self.db_path = db_path
+    for key in self.db_defaults:
+      if key not in self.settings['db']:
+        self.settings['db'][key] = self.db_defaults[key]
+    if self.settings['db']['journal_mode']:
+      self.ex('PRAGMA journal_mode=' + str(self.settings['db']['journal_mode']))
+    synchronous = self.settings['db']['synchronous']
+    if synchronous is None:
+      synchronous = 'NORMAL' if self.settings['db']['durability'] == 'batch' else 'FULL'
+    if synchronous:
+      self.ex('PRAGMA synchronous=' + str(synchronous))
+    self.pending = OrderedDict()
+    self.pending_count = 0
+    self.pending_tables = {}
+    self.last_commit = time.time()
+
+    # Set up the shared HTTP client now, before any crawler threads use it
+    self.http_client()
+
+    # Create the basic data tables if they don't exist, and upgrade them
+    self.excom('CREATE TABLE IF NOT EXISTS zeomine_schema (component text, version int)')
+    migrations = []
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS zeomine_instances (uuid text, description text, time_format text, time real)',
+      'CREATE TABLE IF NOT EXISTS domains (domain text, https int, subdomain_of int)',
+      'CREATE TABLE IF NOT EXISTS urls (url text, domain int)',
+    ])
+    migrations.append([
+      'CREATE INDEX IF NOT EXISTS zeomine_instances_uuid ON zeomine_instances (uuid)',
+      'CREATE INDEX IF NOT EXISTS domains_domain ON domains (domain)',
+      'CREATE INDEX IF NOT EXISTS urls_url ON urls (url)',
+    ])
+    migrations.append([
+      'CREATE TABLE IF NOT EXISTS plugin_watermarks (plugin text, zeomine_instance text, last_rowid int)',
+      'CREATE UNIQUE INDEX IF NOT EXISTS plugin_watermarks_plugin_instance ON plugin_watermarks (plugin, zeomine_instance)',
+    ])
+    self.migrate('Zeomine', migrations)
+
+    # Set up the URL and domain id caches, and the document cache
+    self.load_id_cache()
+    for key in self.document_cache_defaults:
+      if key not in self.settings['document_cache']:
+        self.settings['document_cache'][key] = self.document_cache_defaults[key]
+    self.documents = DocumentCache(self.settings['document_cache']['max_bytes'])
 
     # Add the run instance
     self.excom('INSERT INTO zeomine_instances VALUES (?,?,?,?)', (self.data['metadata']['uuid'], self.settings['description'], self.data['metadata']['time_format'], self.data['metadata']['time']))
@@ -385,5 +656,9 @@ class Zeomine():
       if callable(getattr(self.plugins[plugin], 'shutdown', False)):
         self.plugins[plugin].shutdown()
 
-    # Close the DB, we are done
+    # Write anything still waiting, then close the DB and any pooled connections, we are done
+    self.com(True)
     self.db.close()
+    if self.http:
+      self.http.close()
+      self.http = None
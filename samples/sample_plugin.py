@@ -111,6 +111,19 @@ class SamplePlugin():
 
   ## Core Selenium Crawler callback
   #
-  # 
-  def core_crawler_selenium(self, current_url):
+  # Called while a page is open in the crawler's browser. browser is the
+  # browser the page is in: with a browser pool, use it instead of
+  # parent_obj.browser.
+  def core_crawler_selenium(self, current_url, current_url_id, browser = None):
+    pass
+
+  ##############################################################################
+  # Core Crawler - Document plugins
+  ##############################################################################
+
+  ## Core Crawler document callback
+  #
+  # Called with each internal page's HTML as it is saved. crawl_data is the
+  # crawler_basic_data rowid, for use with z_obj.documents.get(crawl_data, text).
+  def core_crawler_document(self, current_url, current_url_id, crawl_data, text):
     pass